@@ -1,14 +1,25 @@
+import os
 import sys
 import json
-from flask import Flask, Response, request
+import time
+import random
+import cProfile
+from flask import Flask, Response, request, g
 from pyezproxy.server import EzproxyServer
 from pyezproxy.stanzas import StanzaUtil
+from pyezproxy.metrics import REGISTRY, HTTP_REQUESTS, HTTP_REQUEST_SECONDS
 
 args = sys.argv
 server = None
 
 
 app = Flask(__name__)
+# Fraction of requests to run under cProfile, and where to write the stats.
+# Profiling is disabled unless PROFILE_SAMPLE_RATE is set above zero.
+app.config.setdefault("PROFILE_SAMPLE_RATE",
+                      float(os.environ.get("PYEZPROXY_PROFILE_SAMPLE_RATE", 0)))
+app.config.setdefault("PROFILE_DIR",
+                      os.environ.get("PYEZPROXY_PROFILE_DIR", "profiles"))
 
 
 def start(hostname, base_dir, username):
@@ -16,12 +27,77 @@ def start(hostname, base_dir, username):
     global app
     server = EzproxyServer(hostname, base_dir)
     server.login(username)
+    server.watch()
     app.run()
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profiler = None
+    if random.random() < app.config["PROFILE_SAMPLE_RATE"]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at a time since Python 3.12,
+            # so skip sampling while another request is being profiled
+            return
+        g.profiler = profiler
+
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(error=None):
+    # Runs even when the request failed with an unhandled exception, when
+    # after_request handlers are skipped, so failures are counted as 500s
+    profiler = g.get("profiler")
+    if profiler is not None:
+        profiler.disable()
+    # Label by URL rule rather than path to keep the number of series bounded
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - g.request_start,
+        method=request.method, route=route)
+    HTTP_REQUESTS.inc(
+        method=request.method, route=route,
+        status=g.get("response_status", 500))
+    # Write the profile after recording the latency, so writing it is not
+    # counted as part of the request
+    if profiler is not None:
+        os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+        profiler.dump_stats(os.path.join(
+            app.config["PROFILE_DIR"],
+            f"{time.time():.6f}-{request.endpoint or 'unmatched'}.prof"))
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(),
+                    mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/")
 def status():
-    return Response(json.dumps(server.options), mimetype="application/json")
+    return Response(json.dumps(server.options.to_dict()),
+                    mimetype="application/json")
+
+
+@app.route("/options/<name>", methods=["GET"])
+def get_option(name):
+    if name not in server.options:
+        return "Option not found", 404
+    return_json = {
+        "name": server.options.get_name(name),
+        "values": server.options.get_all(name),
+        "lines": server.options.get_lines(name)
+    }
+    return Response(json.dumps(return_json), mimetype="application/json")
 
 
 @app.route("/stanzas", methods=["GET", "POST"])
@@ -41,11 +117,19 @@ def stanzas_router():
 
 
 def get_stanzas():
+    return filter_stanzas(server.list_stanzas())
+
+
+def filter_stanzas(stanzas):
+    """
+    Builds a listing for the given (zero-based position, ID, stanza) tuples,
+    filtered by the "name" or "url" query parameters if present
+    """
     return_json = []
 
-    for i in range(len(server.stanzas)):
-        stanza = server.stanzas[i]
+    for i, stanza_id, stanza in stanzas:
         stanza_info = {
+            "id": stanza_id,
             "position": i + 1,
             "name": stanza.name,
             "origins": list(stanza.get_origins())
@@ -68,12 +152,49 @@ def get_stanzas():
 
 def create_stanza(stanza_text):
     stanza = StanzaUtil.parse_stanza(stanza_text)
-    server.stanzas.append(stanza)
-    return "Stanza created.", 201
+    try:
+        stanza_id = server.add_stanza(stanza)
+    except RuntimeError as error:
+        return str(error), 409
+    return "Stanza created.", 201, {"Location": "/stanzas/id/" + stanza_id}
+
+
+@app.route("/stanzas/bulk", methods=["POST"])
+def import_stanzas():
+    """
+    Creates stanzas from a databases.conf fragment. All stanzas must have a
+    Title and URL, or none are created. POST request takes the following JSON
+    schema, where position is optional and defaults to the end of the file:
+    {
+        "text": "#### Example START ####\nTitle Example Database\n...",
+        "position": 1
+    }
+    """
+    request_json = request.get_json()
+    position = request_json.get("position")
+    if position is not None and not is_position(position):
+        return "Position must be an integer", 400
+    try:
+        inserted = server.import_stanzas(
+            request_json.get("text") or "",
+            None if position is None else position - 1)
+    except ValueError as error:
+        return str(error), 400
+    except RuntimeError as error:
+        return str(error), 409
+    return_json = {
+        "created": len(inserted),
+        "positions": [i + 1 for i, _ in inserted],
+        "ids": [stanza_id for _, stanza_id in inserted]
+    }
+    return Response(json.dumps(return_json), status=201,
+                    mimetype="application/json")
 
 
 @app.route("/stanzas/<int:position>", methods=["GET", "PUT", "PATCH"])
 def stanza_detail_router(position):
+    if position < 1:
+        return "Stanza not found", 404
     if request.method == "GET":
         return get_stanza_detail(position)
     elif request.method == "PUT":
@@ -83,13 +204,61 @@ def stanza_detail_router(position):
         return move_stanza(position, new_position)
 
 
+@app.route("/stanzas/id/<stanza_id>", methods=["GET", "PUT", "PATCH"])
+def stanza_id_router(stanza_id):
+    """
+    Same as /stanzas/<position>, but addresses the stanza by its ID, which
+    does not change when stanzas are added, moved or edited. IDs are derived
+    from stanza titles, so they are the same after a restart unless a
+    stanza's title, or its order among stanzas with the same title, was
+    changed by hand.
+    """
+    if request.method == "GET":
+        try:
+            position, stanza = server.get_stanza_by_id(stanza_id)
+        except KeyError:
+            return "Stanza not found", 404
+        return stanza_detail(position + 1, stanza_id, stanza)
+    elif request.method == "PUT":
+        stanza = StanzaUtil.parse_stanza(request.get_json().get("text"))
+        try:
+            server.replace_stanza_by_id(stanza_id, stanza)
+        except KeyError:
+            return "Stanza not found", 404
+        except RuntimeError as error:
+            return str(error), 409
+        return "Stanza updated.", 200
+    elif request.method == "PATCH":
+        new_position = request.get_json().get("position")
+        if not is_position(new_position):
+            return "Position must be an integer", 400
+        try:
+            server.move_stanza_by_id(stanza_id, new_position - 1)
+        except KeyError:
+            return "Stanza not found", 404
+        except ValueError as error:
+            return str(error), 400
+        except RuntimeError as error:
+            return str(error), 409
+        return "Stanza moved.", 200
+
+
+def is_position(position):
+    """Returns whether a JSON value is a valid stanza position"""
+    return isinstance(position, int) and not isinstance(position, bool)
+
+
 def get_stanza_detail(position):
     try:
-        stanza = server.stanzas[position - 1]
+        stanza_id, stanza = server.get_stanza(position - 1)
     except IndexError:
         return "Stanza not found", 404
+    return stanza_detail(position, stanza_id, stanza)
 
+
+def stanza_detail(position, stanza_id, stanza):
     return_json = {
+            "id": stanza_id,
             "position": position,
             "name": stanza.name,
             "group": stanza.get_group(),
@@ -100,17 +269,101 @@ def get_stanza_detail(position):
 
 
 def update_stanza(position, stanza_text):
-    server.stanzas[position - 1] = StanzaUtil.parse_stanza(stanza_text)
+    try:
+        server.replace_stanza(
+            position - 1, StanzaUtil.parse_stanza(stanza_text))
+    except IndexError:
+        return "Stanza not found", 404
+    except RuntimeError as error:
+        return str(error), 409
     return "Stanza updated.", 200
 
 
 def move_stanza(current_position, new_position):
-    if current_position == new_position:
-        pass
-    else:
-        stanza = server.stanzas.pop(current_position - 1)
-        server.stanzas.insert(new_position - 1, stanza)
-        return "Stanza moved.", 200
+    if not is_position(new_position):
+        return "Position must be an integer", 400
+    try:
+        server.move_stanza(current_position - 1, new_position - 1)
+    except IndexError:
+        return "Stanza not found", 404
+    except ValueError as error:
+        return str(error), 400
+    except RuntimeError as error:
+        return str(error), 409
+    return "Stanza moved.", 200
+
+
+@app.route("/analysis", methods=["GET"])
+def get_analysis():
+    """
+    Reports conflicts between stanzas. Responds with 409 if any origins are
+    duplicated or stanzas shadowed, so it can gate a restart.
+    """
+    report = server.analyze_stanzas(start=1)
+    status_code = 200
+    if report["duplicate_origins"] or report["shadowed_stanzas"]:
+        status_code = 409
+    return Response(json.dumps(report), status=status_code,
+                    mimetype="application/json")
+
+
+@app.route("/sync", methods=["GET"])
+def get_sync_manifest():
+    """
+    Returns the digest and ordered stanza hashes of this instance. To sync
+    another instance from this one, POST the other instance's manifest to
+    /sync/delta here, then POST the result to /sync/apply there.
+    """
+    return Response(json.dumps(server.get_manifest()),
+                    mimetype="application/json")
+
+
+@app.route("/sync/delta", methods=["POST"])
+def get_sync_delta():
+    """
+    Computes the changes needed to bring another instance in line with this
+    one. POST request takes the other instance's GET /sync response.
+    """
+    try:
+        delta = server.get_delta(request.get_json())
+    except (KeyError, TypeError) as error:
+        return f"Invalid manifest: {error}", 400
+    return Response(json.dumps(delta), mimetype="application/json")
+
+
+@app.route("/sync/apply", methods=["POST"])
+def apply_sync_delta():
+    """
+    Applies a delta from another instance's /sync/delta to this instance's
+    stanzas and writes databases.conf. EZproxy is not restarted.
+    """
+    try:
+        changed = server.apply_delta(request.get_json())
+    except (KeyError, TypeError) as error:
+        return f"Invalid delta: {error}", 400
+    except (ValueError, RuntimeError) as error:
+        return str(error), 409
+    if not changed:
+        return "Stanzas already in sync.", 200
+    return "Stanzas synchronized.", 200
+
+
+@app.route("/groups", methods=["GET"])
+def get_groups():
+    return_json = []
+    for group, count in server.get_group_sizes().items():
+        return_json.append({
+            "name": group,
+            "count": count
+        })
+    return Response(json.dumps(return_json), mimetype='application/json')
+
+
+@app.route("/groups/<name>/stanzas", methods=["GET"])
+def get_group_stanzas(name):
+    if name not in server.get_groups():
+        return "Group not found", 404
+    return filter_stanzas(server.get_group_stanzas(name))
 
 
 if __name__ == "__main__":
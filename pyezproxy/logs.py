@@ -0,0 +1,227 @@
+"""Module for mapping EZproxy access log entries to stanzas"""
+import os
+import re
+import sys
+import mmap
+import json
+import argparse
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from .stanzas import StanzaUtil
+
+# Matches the %t and %r fields of EZproxy's default LogFormat,
+# %h %l %u %t "%r" %s %b, capturing the timestamp and the request URL
+LOG_PATTERN = re.compile(rb'\[([^\]\n]+)\] "[A-Z]+ ([^ "\n]+)')
+TIMESTAMP_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+# Upper bound on cached origin and timestamp lookups per worker
+CACHE_SIZE = 100000
+
+
+class OriginIndex:
+    """
+    Class mapping request URLs to the position of the first stanza with a
+    matching origin or Domain, as EZproxy itself would choose
+    """
+
+    def __init__(self, stanzas):
+        # hostname -> (origin, position) pairs in stanza order
+        self.hosts = {}
+        # domain -> position of the first stanza with that Domain directive
+        self.domains = {}
+        for position, stanza in enumerate(stanzas):
+            for origin in sorted(stanza.get_origins()):
+                hostname = urlparse(origin).hostname
+                if hostname:
+                    self.hosts.setdefault(hostname, []) \
+                        .append((origin, position))
+            for domain in StanzaUtil.get_domains(stanza):
+                self.domains.setdefault(domain, position)
+        self.cache = {}
+
+    def resolve(self, url):
+        """Returns the position of the stanza for a URL, or None"""
+        # Cache on the scheme and host part of the URL, which is much
+        # cheaper to cut out than parsing the URL
+        start = url.find("//")
+        end = url.find("/", start + 2) if start != -1 else -1
+        key = url if end == -1 else url[:end]
+        if key in self.cache:
+            return self.cache[key]
+        position = None
+        try:
+            origin = StanzaUtil.translate_url_origin(key)
+            hostname = urlparse(origin).hostname
+        except ValueError:
+            hostname = None
+        for candidate, candidate_position in \
+                self.hosts.get(hostname, ()):
+            if StanzaUtil.match_origin_url(origin, candidate):
+                position = candidate_position
+                break
+        if hostname and self.domains:
+            # A Domain covers the host itself and every host below it, for
+            # any scheme and port, so check each suffix of the hostname
+            labels = hostname.split(".")
+            for i in range(len(labels)):
+                domain_position = self.domains.get(".".join(labels[i:]))
+                if domain_position is not None and \
+                        (position is None or domain_position < position):
+                    position = domain_position
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[key] = position
+        return position
+
+
+def get_chunks(log_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns (path, start, end) byte ranges covering a log file, each ending
+    on a line boundary
+    """
+    size = os.path.getsize(log_path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(log_path, "rb") as log_file, \
+            mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+        start = 0
+        while start < size:
+            end = log.find(b"\n", min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            chunks.append((log_path, start, end))
+            start = end
+    return chunks
+
+
+def analyze_chunk(chunk, index):
+    """
+    Counts the hits per stanza position in one byte range of a log file.
+    Returns a dict of position (None for unmatched requests) to
+    [hits, last seen datetime].
+    """
+    log_path, start, end = chunk
+    usage = {}
+    timestamps = {}
+    with open(log_path, "rb") as log_file, \
+            mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+        for match in LOG_PATTERN.finditer(log, start, end):
+            raw_timestamp, target = match.groups()
+            url = _get_request_url(target.decode("latin-1"))
+            position = index.resolve(url) if url else None
+
+            timestamp = timestamps.get(raw_timestamp)
+            if timestamp is None:
+                try:
+                    timestamp = datetime.strptime(
+                        raw_timestamp.decode("latin-1"), TIMESTAMP_FORMAT)
+                except ValueError:
+                    continue
+                if len(timestamps) >= CACHE_SIZE:
+                    timestamps.clear()
+                timestamps[raw_timestamp] = timestamp
+
+            stanza_usage = usage.get(position)
+            if stanza_usage is None:
+                usage[position] = [1, timestamp]
+            else:
+                stanza_usage[0] += 1
+                if timestamp > stanza_usage[1]:
+                    stanza_usage[1] = timestamp
+    return usage
+
+
+def _get_request_url(target):
+    # Proxied requests are logged with the full URL. Requests to the login
+    # page name the starting point URL in the url or qurl parameter.
+    if "//" in target[:10]:
+        return target
+    if target.startswith("/login"):
+        query = parse_qs(urlparse(target).query)
+        for key in ("url", "qurl"):
+            if query.get(key):
+                return query[key][0]
+    return None
+
+
+_worker_index = None
+
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def _analyze_chunk_in_worker(chunk):
+    return analyze_chunk(chunk, _worker_index)
+
+
+def analyze_logs(log_paths, stanzas, processes=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads EZproxy access logs in memory-mapped chunks and returns the hits
+    and last-seen time of every stanza, in stanza order, along with the
+    number of requests that matched no stanza. Chunks are analyzed in a
+    pool of the given number of processes, or in this process if
+    processes is None or 1.
+    """
+    stanzas = list(stanzas)
+    index = OriginIndex(stanzas)
+    chunks = []
+    for log_path in log_paths:
+        chunks.extend(get_chunks(log_path, chunk_size))
+
+    if processes is None or processes <= 1:
+        results = (analyze_chunk(chunk, index) for chunk in chunks)
+        usage = _merge_usage(results)
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_worker,
+                                 initargs=(index,)) as executor:
+            usage = _merge_usage(
+                executor.map(_analyze_chunk_in_worker, chunks))
+
+    report = {"stanzas": [], "unmatched": usage.get(None, [0])[0]}
+    for position in range(len(stanzas)):
+        hits, last_seen = usage.get(position, [0, None])
+        report["stanzas"].append({
+            "position": position,
+            "name": stanzas[position].name,
+            "hits": hits,
+            "last_seen": last_seen.isoformat() if last_seen else None
+        })
+    return report
+
+
+def _merge_usage(results):
+    usage = {}
+    for result in results:
+        for position, (hits, last_seen) in result.items():
+            if position not in usage:
+                usage[position] = [hits, last_seen]
+            else:
+                usage[position][0] += hits
+                usage[position][1] = max(usage[position][1], last_seen)
+    return usage
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Count EZproxy access log hits per database stanza")
+    parser.add_argument("base_dir", help="EZproxy directory")
+    parser.add_argument("log_paths", nargs="+", help="access log files")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of worker processes")
+    options = parser.parse_args(args)
+
+    with open(options.base_dir + "/config/databases.conf", "r") \
+            as stanza_file:
+        stanzas = StanzaUtil.parse_stanzas(stanza_file.read())
+    report = analyze_logs(options.log_paths, stanzas, options.processes)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
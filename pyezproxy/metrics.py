@@ -0,0 +1,216 @@
+"""Module for collecting runtime metrics in Prometheus text format"""
+import time
+import threading
+from functools import wraps
+
+
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Counter:
+    """Class for a monotonically increasing metric"""
+
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter for the given label values"""
+        key = _label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """Returns (name, labels, value) tuples for the exposition format"""
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Class for a metric that counts observations into buckets"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Record a single observation for the given label values"""
+        key = _label_key(self.labelnames, labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0
+                }
+            series = self.values[key]
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]:
+                    series["buckets"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def time(self, **labels):
+        """
+        Returns a timer that records its duration in seconds. The timer can
+        be used as a context manager or as a function decorator.
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        """Returns (name, labels, value) tuples for the exposition format"""
+        with self.lock:
+            values = [
+                (key, list(series["buckets"]), series["sum"], series["count"])
+                for key, series in self.values.items()
+            ]
+        for key, buckets, total, count in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for i in range(len(self.buckets)):
+                cumulative += buckets[i]
+                yield (self.name + "_bucket",
+                       dict(labels, le=_format_value(self.buckets[i])),
+                       cumulative)
+            yield self.name + "_bucket", dict(labels, le="+Inf"), count
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class Timer:
+    """Context manager and decorator timing a block into a histogram"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(
+            time.perf_counter() - self.start, **self.labels)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.histogram.observe(
+                    time.perf_counter() - start, **self.labels)
+        return wrapper
+
+
+class MetricsRegistry:
+    """Class holding a set of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.register(
+            Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " +
+                         metric.documentation.replace("\\", "\\\\")
+                         .replace("\n", "\\n"))
+            lines.append("# TYPE " + metric.name + " " + metric.metric_type)
+            for name, labels, value in metric.samples():
+                lines.append(name + _format_labels(labels) + " " +
+                             _format_value(value))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(
+            f"Expected labels {labelnames}. Got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = value.replace("\\", "\\\\").replace("\n", "\\n") \
+            .replace('"', '\\"')
+        pairs.append(name + '="' + value + '"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+REGISTRY = MetricsRegistry()
+
+CONFIG_PARSE_SECONDS = REGISTRY.histogram(
+    "pyezproxy_config_parse_seconds",
+    "Time spent reading and parsing EZproxy configuration files.",
+    ["file"]
+)
+SEARCH_SECONDS = REGISTRY.histogram(
+    "pyezproxy_search_seconds",
+    "Time spent searching stanzas by URL or name.",
+)
+ADMIN_REQUEST_SECONDS = REGISTRY.histogram(
+    "pyezproxy_admin_request_seconds",
+    "Round-trip time of requests to the EZproxy admin interface.",
+    ["action"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+RESTARTS = REGISTRY.counter(
+    "pyezproxy_restarts_total",
+    "Number of EZproxy restarts requested, by result.",
+    ["result"]
+)
+RELOADS = REGISTRY.counter(
+    "pyezproxy_config_reloads_total",
+    "Number of configuration file reloads, by file and result.",
+    ["file", "result"]
+)
+HTTP_REQUESTS = REGISTRY.counter(
+    "pyezproxy_http_requests_total",
+    "Number of API requests handled, by route and status code.",
+    ["method", "route", "status"]
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "pyezproxy_http_request_seconds",
+    "Time spent handling API requests, by route.",
+    ["method", "route"]
+)
@@ -0,0 +1,113 @@
+"""Module for working with EZproxy server.conf options"""
+
+from collections import OrderedDict
+
+
+class ServerOptions:
+    """
+    Class for the directives of an EZproxy server.conf file.
+    Directives are kept in file order and indexed by lowercased name, so a
+    directive may be looked up regardless of case and may repeat.
+    """
+
+    def __init__(self, options_text=""):
+        self.lines = options_text.splitlines()
+        # Each entry is [key, value, line index] in file order
+        self.entries = []
+        self.index = {}
+        for i in range(len(self.lines)):
+            line = self.lines[i].strip()
+            # Skip empty lines and comments
+            if line and line.startswith("#") is False:
+                param = line.split(None, 1)
+                # Force inital letter of key to be uppercase
+                key = param[0][:1].upper() + param[0][1:]
+                value = param[1].strip() if len(param) > 1 else ""
+                self.__add_entry(len(self.entries), key, value, i)
+
+    def __add_entry(self, position, key, value, line):
+        self.entries.insert(position, [key, value, line])
+        if position != len(self.entries) - 1:
+            self.__reindex()
+        else:
+            self.index.setdefault(key.lower(), []).append(position)
+
+    def __reindex(self):
+        index = {}
+        for i in range(len(self.entries)):
+            index.setdefault(self.entries[i][0].lower(), []).append(i)
+        self.index = index
+
+    def __contains__(self, name):
+        return name.lower() in self.index
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for key, value, _ in self.entries:
+            yield key, value
+
+    def get(self, name, default=None):
+        """Returns the first value of a directive"""
+        positions = self.index.get(name.lower())
+        if not positions:
+            return default
+        return self.entries[positions[0]][1]
+
+    def get_all(self, name):
+        """Returns all values of a directive in file order"""
+        return [self.entries[i][1] for i in self.index.get(name.lower(), [])]
+
+    def get_lines(self, name):
+        """Returns the (one-based) line numbers of a directive"""
+        return [self.entries[i][2] + 1
+                for i in self.index.get(name.lower(), [])]
+
+    def get_name(self, name):
+        """Returns the name of a directive as first written in the file"""
+        positions = self.index.get(name.lower())
+        if not positions:
+            return None
+        return self.entries[positions[0]][0]
+
+    def set(self, name, value):
+        """
+        Replace the value of the first occurrence of a directive in place,
+        adding the directive if it is not present
+        """
+        positions = self.index.get(name.lower())
+        if not positions:
+            self.add(name, value)
+            return
+        entry = self.entries[positions[0]]
+        entry[1] = value
+        self.lines[entry[2]] = entry[0] + " " + value
+
+    def add(self, name, value):
+        """
+        Add a directive after its last occurrence, or at the end of the file
+        if it is not present
+        """
+        positions = self.index.get(name.lower())
+        if positions:
+            position = positions[-1] + 1
+            line = self.entries[positions[-1]][2] + 1
+        else:
+            position = len(self.entries)
+            line = len(self.lines)
+        self.lines.insert(line, name + " " + value)
+        for entry in self.entries[position:]:
+            entry[2] += 1
+        self.__add_entry(position, name, value, line)
+
+    def to_dict(self):
+        """Returns an ordered mapping of directive names to their values"""
+        options = OrderedDict()
+        for name in self.index:
+            options[self.get_name(name)] = self.get_all(name)
+        return options
+
+    def get_text(self):
+        """Returns the server.conf text, including any edits"""
+        return "\n".join(self.lines) + "\n"
@@ -1,9 +1,22 @@
 """Module for controlling EZProxy server instance"""
+import os
 import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
 import requests
 from bs4 import BeautifulSoup
 from . import stanzas
-from .stanzas import StanzaUtil
+from .stanzas import Stanza, StanzaUtil
+from .options import ServerOptions
+from .stanzalist import StanzaList
+from .watcher import ConfigWatcher, get_signature
+from .logs import analyze_logs
+from .metrics import (
+    ADMIN_REQUEST_SECONDS, CONFIG_PARSE_SECONDS, RELOADS, RESTARTS,
+    SEARCH_SECONDS
+)
 
 
 class EzproxyServer:
@@ -11,28 +24,159 @@ class EzproxyServer:
     def __init__(self, hostname, base_dir):
         self.hostname = hostname
         self.base_dir = base_dir
+        # Guards swapping in newly parsed state and edits to the stanza list
+        self.lock = threading.RLock()
+        self.watcher = None
+        self.stanzas = StanzaList()
+        self.groups = OrderedDict()
+        # Text of databases.conf outside the stanzas: the text before the
+        # first stanza, the text before each later stanza by ID, and the
+        # text after the last stanza. The header and trailing text stay in
+        # place when stanzas are moved.
+        self.header_text = ""
+        self.leading_text = {}
+        self.trailing_text = ""
+        # Signature of databases.conf as last read or written, to detect
+        # changes made by others before writing over them
+        self.stanzas_signature = None
+        self.options_signature = None
         self.__set_stanzas()
         self.__set_server_options()
         self.auth_cookie = None
         self.pid = None
 
+    @CONFIG_PARSE_SECONDS.time(file="databases.conf")
     def __set_stanzas(self):
-        with open(self.base_dir + "/config/databases.conf", "r") as stanza_file:
-            self.stanzas = StanzaUtil.parse_stanzas(stanza_file.read())
+        path = self.base_dir + "/config/databases.conf"
+        while True:
+            # Parse outside the lock so readers only wait for the swap itself
+            signature = get_signature(path)
+            with open(path, "r") as stanza_file:
+                parsed_stanzas, leading_texts, trailing_text = \
+                    StanzaUtil.parse_stanza_file(stanza_file.read())
+            with self.lock:
+                previous_items = list(self.stanzas.items())
+            ids = self.__assign_ids(parsed_stanzas, previous_items)
+            stanzas = StanzaList(parsed_stanzas, ids)
+            groups = self.__index_groups(stanzas)
+            header_text = leading_texts[0] if leading_texts else ""
+            stanza_ids = [stanza_id for stanza_id, _ in stanzas.items()]
+            leading_text = dict(zip(stanza_ids[1:], leading_texts[1:]))
+            with self.lock:
+                # If the file was written while it was being parsed, possibly
+                # by an edit through this server, read it again
+                if get_signature(path) != signature:
+                    continue
+                self.stanzas = stanzas
+                self.groups = groups
+                self.header_text = header_text
+                self.leading_text = leading_text
+                self.trailing_text = trailing_text
+                self.stanzas_signature = signature
+                return
 
+    def __assign_ids(self, new_stanzas, previous_items=(), taken=()):
+        # Stanzas keep the ID of an equal previous stanza, or else of one
+        # with the same name, so clients holding an ID can still find them
+        # after a reload. Other stanzas get an ID derived from their name
+        # and the number of stanzas before them with that name, so loading
+        # the same file in a new process gives the same IDs.
+        same_hash = OrderedDict()
+        same_name = OrderedDict()
+        for stanza_id, stanza in previous_items:
+            same_hash.setdefault(stanza.get_hash(), []).append(stanza_id)
+            same_name.setdefault(stanza.name, []).append(stanza_id)
+        used = set(taken)
+        ids = [None] * len(new_stanzas)
+        for previous_ids, key in ((same_hash, Stanza.get_hash),
+                                  (same_name, lambda stanza: stanza.name)):
+            for i, stanza in enumerate(new_stanzas):
+                candidates = previous_ids.get(key(stanza), [])
+                while ids[i] is None and candidates:
+                    stanza_id = candidates.pop(0)
+                    if stanza_id not in used:
+                        ids[i] = stanza_id
+                        used.add(stanza_id)
+        for i, stanza in enumerate(new_stanzas):
+            if ids[i] is None:
+                base_id = hashlib.sha256(
+                    (stanza.name or "").encode("utf-8")).hexdigest()[:16]
+                stanza_id = base_id
+                occurrence = 1
+                while stanza_id in used:
+                    occurrence += 1
+                    stanza_id = f"{base_id}-{occurrence}"
+                ids[i] = stanza_id
+                used.add(stanza_id)
+        return ids
+
+    def __index_groups(self, stanzas):
+        # Map each group name to the IDs of its stanzas. Positions are looked
+        # up from the IDs when needed, so reordering leaves the index as is.
+        groups = OrderedDict()
+        for stanza_id, stanza in stanzas.items():
+            groups.setdefault(stanza.get_group(), OrderedDict())[stanza_id] \
+                = None
+        return groups
+
+    def __add_to_group(self, stanza_id, group):
+        self.groups.setdefault(group, OrderedDict())[stanza_id] = None
+
+    def __remove_from_group(self, stanza_id, group):
+        del self.groups[group][stanza_id]
+        if not self.groups[group]:
+            del self.groups[group]
+
+    @CONFIG_PARSE_SECONDS.time(file="server.conf")
     def __set_server_options(self):
-        with open(self.base_dir + "/config/server.conf", "r") as options_file:
-            options_array = []
-            options_text = options_file.read()
-            for line in options_text.splitlines():
-                # Skip empty lines and comments
-                if line.strip() and line.startswith("#") is False:
-                    param = line.strip().split(' ', 1)
-                    # Force inital letter of key to be uppercase
-                    key = param[0][:1].upper() + param[0][1:]
-                    value = param[1].strip()
-                    options_array.append({key: value})
-            self.options = options_array
+        path = self.base_dir + "/config/server.conf"
+        signature = get_signature(path)
+        with open(path, "r") as options_file:
+            self.options = ServerOptions(options_file.read())
+        self.options_signature = signature
+
+    def reload_stanzas(self):
+        """Re-read databases.conf, replacing the current stanzas"""
+        try:
+            self.__set_stanzas()
+        except Exception:
+            RELOADS.inc(file="databases.conf", result="failure")
+            raise
+        RELOADS.inc(file="databases.conf", result="success")
+
+    def reload_server_options(self):
+        """Re-read server.conf, replacing the current options"""
+        try:
+            self.__set_server_options()
+        except Exception:
+            RELOADS.inc(file="server.conf", result="failure")
+            raise
+        RELOADS.inc(file="server.conf", result="success")
+
+    def watch(self, debounce=1.0, poll_interval=2.0):
+        """
+        Start a background thread reloading databases.conf and server.conf
+        when they change on disk
+        """
+        if self.watcher is None:
+            stanzas_path = self.base_dir + "/config/databases.conf"
+            options_path = self.base_dir + "/config/server.conf"
+            self.watcher = ConfigWatcher({
+                stanzas_path: self.reload_stanzas,
+                options_path: self.reload_server_options
+            }, debounce, poll_interval, {
+                # Reload files changed since they were loaded
+                stanzas_path: self.stanzas_signature,
+                options_path: self.options_signature
+            })
+            self.watcher.start()
+        return self.watcher
+
+    def stop_watching(self):
+        """Stop the background configuration watcher"""
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
 
     def login(self, username, password=None):
         """Login to an instance of EZProxy"""
@@ -50,11 +194,12 @@ class EzproxyServer:
             "pass": password
         }
 
-        auth = requests.post(
-            login_url,
-            data=credentials,
-            allow_redirects=False
-        )
+        with ADMIN_REQUEST_SECONDS.time(action="login"):
+            auth = requests.post(
+                login_url,
+                data=credentials,
+                allow_redirects=False
+            )
         auth_cookie = {}
         for key in auth.cookies.keys():
             if key.startswith("EZProxy"):
@@ -76,11 +221,12 @@ class EzproxyServer:
     def get_pid(self):
         """Get the current PID of EZProxy"""
         restart_url = "https://login." + self.hostname + "/restart"
-        restart_form = requests.get(
-            restart_url,
-            cookies=self.auth_cookie,
-            allow_redirects=False
-        )
+        with ADMIN_REQUEST_SECONDS.time(action="get_pid"):
+            restart_form = requests.get(
+                restart_url,
+                cookies=self.auth_cookie,
+                allow_redirects=False
+            )
         pid = BeautifulSoup(restart_form.text, "html.parser") \
             .find_all(attrs={"name": "pid"})[0] \
             .attrs["value"]
@@ -95,18 +241,21 @@ class EzproxyServer:
         }
 
         try:
-            restart_request = requests.post(
-                restart_url,
-                data=restart_payload,
-                cookies=self.auth_cookie
-            )
+            with ADMIN_REQUEST_SECONDS.time(action="restart"):
+                restart_request = requests.post(
+                    restart_url,
+                    data=restart_payload,
+                    cookies=self.auth_cookie
+                )
             if (BeautifulSoup(restart_request.text, "html.parser")
                 .h1.next_sibling.strip() ==
                     "EZproxy will restart in 5 seconds."):
+                RESTARTS.inc(result="success")
                 if no_wait is False:
                     time.sleep(5)
                 self.get_pid()
             else:
+                RESTARTS.inc(result="failure")
                 RuntimeError("Failed to restart server.")
         except RuntimeError:
             pass
@@ -115,15 +264,370 @@ class EzproxyServer:
     def get_stanzas(self):
         return self.stanzas
 
-    def search_proxy(self, url=None, name=None):
+    def write_stanzas(self):
+        """Write the current stanzas back to databases.conf"""
+        with self.lock:
+            self.__write_stanzas(self.stanzas.items(), self.leading_text)
+
+    def __render_stanzas(self, stanza_items, leading_text):
+        # Stanzas read from databases.conf are written back as they were
+        # found, along with the comments and blank lines before them.
+        # Other stanzas are printed and set off with a blank line.
+        parts = [self.header_text] if self.header_text else []
+        for stanza_id, stanza in stanza_items:
+            if parts and not parts[-1].endswith("\n"):
+                parts.append("\n")
+            leading = leading_text.get(stanza_id)
+            if leading is not None:
+                parts.append(leading)
+            elif parts and not "".join(parts[-2:]).endswith("\n\n"):
+                parts.append("\n")
+            if stanza.text is not None:
+                parts.append(stanza.text)
+            else:
+                parts.append(StanzaUtil.print_stanzas([stanza]))
+        if self.trailing_text and parts and not parts[-1].endswith("\n"):
+            parts.append("\n")
+        parts.append(self.trailing_text)
+        return "".join(parts)
+
+    def __write_stanzas(self, stanza_items, leading_text):
+        """
+        Write the given (ID, stanza) pairs to databases.conf. Callers update
+        the in-memory stanzas only after this succeeds. Raises RuntimeError
+        if databases.conf was changed by others since it was last loaded.
+        """
+        path = self.base_dir + "/config/databases.conf"
+        if get_signature(path) != self.stanzas_signature:
+            raise RuntimeError(
+                "databases.conf changed on disk and has not been reloaded")
+        text = self.__render_stanzas(stanza_items, leading_text)
+        # Replace the file in one step so EZproxy never reads a partial file
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except OSError:
+            mode = 0o644
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w") as stanza_file:
+                stanza_file.write(text)
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.stanzas_signature = get_signature(path)
+        if self.watcher is not None:
+            self.watcher.record(path)
+
+    def import_stanzas(self, stanza_text, position=None):
+        """
+        Parse a databases.conf fragment and insert all of its stanzas at
+        the given (zero-based) position, or at the end if no position is
+        given. Nothing is inserted unless every stanza is valid.
+        Returns (zero-based position, ID) pairs for the inserted stanzas.
+        """
+        try:
+            new_stanzas = StanzaUtil.parse_stanza_file(stanza_text)[0]
+        except IndexError:
+            raise ValueError("Every directive must have a value")
+        if not new_stanzas:
+            raise ValueError("No stanzas found")
+        errors = []
+        for i in range(len(new_stanzas)):
+            missing = StanzaUtil.get_missing_directives(new_stanzas[i])
+            if missing:
+                errors.append(f"Stanza {i + 1} ({new_stanzas[i].name}) "
+                              f"is missing {', '.join(missing)}")
+        if errors:
+            raise ValueError("; ".join(errors))
+        return self.insert_stanzas(new_stanzas, position)
+
+    def insert_stanzas(self, new_stanzas, position=None):
+        """
+        Insert stanzas at the given (zero-based) position, or at the end if
+        no position is given, then write databases.conf once.
+        Returns (zero-based position, ID) pairs for the inserted stanzas,
+        taken while the stanzas cannot be moved by other edits.
+        """
+        new_stanzas = list(new_stanzas)
+        with self.lock:
+            if position is None:
+                position = len(self.stanzas)
+            elif not 0 <= position <= len(self.stanzas):
+                raise ValueError(f"Position {position} is out of range")
+            ids = self.__assign_ids(new_stanzas, taken=self.stanzas.nodes)
+            stanza_items = list(self.stanzas.items())
+            leading_text = dict(self.leading_text)
+            if position < len(stanza_items) and new_stanzas:
+                # Splice the new stanzas in just before the START line of the
+                # stanza they are inserted before, below any comments above it
+                target_id = stanza_items[position][0]
+                leading_text[ids[0]] = leading_text.get(target_id)
+                leading_text[target_id] = "\n"
+            stanza_items[position:position] = zip(ids, new_stanzas)
+            self.__write_stanzas(stanza_items, leading_text)
+
+            self.stanzas.insert_all(position, new_stanzas, ids)
+            for stanza_id, stanza in zip(ids, new_stanzas):
+                self.__add_to_group(stanza_id, stanza.get_group())
+            self.leading_text = leading_text
+        return list(zip(range(position, position + len(ids)), ids))
+
+    def add_stanza(self, stanza):
+        """
+        Append a stanza to the end of the stanza list and write
+        databases.conf, returning the stanza's ID
+        """
+        return self.insert_stanzas([stanza])[0][1]
+
+    def replace_stanza(self, position, stanza):
+        """
+        Replace the stanza at the given (zero-based) position and write
+        databases.conf
+        """
+        with self.lock:
+            self.replace_stanza_by_id(self.stanzas.get_id(position), stanza)
+
+    def replace_stanza_by_id(self, stanza_id, stanza):
+        """
+        Replace the stanza with the given ID and write databases.conf.
+        Raises KeyError if there is no such stanza.
+        """
+        with self.lock:
+            position = self.stanzas.index(stanza_id)
+            stanza_items = list(self.stanzas.items())
+            stanza_items[position] = (stanza_id, stanza)
+            self.__write_stanzas(stanza_items, self.leading_text)
+
+            previous_group = self.stanzas[position].get_group()
+            self.stanzas[position] = stanza
+            if stanza.get_group() != previous_group:
+                self.__remove_from_group(stanza_id, previous_group)
+                self.__add_to_group(stanza_id, stanza.get_group())
+
+    def move_stanza(self, current_position, new_position):
+        """
+        Move a stanza from one (zero-based) position to another and write
+        databases.conf. The comments above the stanza move with it, except
+        for the text at the top of the file, which stays in place.
+        """
+        with self.lock:
+            self.move_stanza_by_id(
+                self.stanzas.get_id(current_position), new_position)
+
+    def move_stanza_by_id(self, stanza_id, new_position):
+        """
+        Move the stanza with the given ID to a (zero-based) position and
+        write databases.conf. Raises KeyError if there is no such stanza,
+        or ValueError if the position is out of range.
+        """
+        with self.lock:
+            current_position = self.stanzas.index(stanza_id)
+            if not 0 <= new_position < len(self.stanzas):
+                raise ValueError(f"Position {new_position} is out of range")
+            if current_position == new_position:
+                return
+            stanza_items = list(self.stanzas.items())
+            stanza_items.insert(
+                new_position, stanza_items.pop(current_position))
+            leading_text = dict(self.leading_text)
+            # Comments above a stanza usually describe it, so they move with
+            # it, set off from the stanza they now follow by a blank line
+            leading = leading_text.get(stanza_id)
+            if leading and not leading.startswith("\n") and \
+                    (new_position or self.header_text):
+                leading_text[stanza_id] = "\n" + leading
+            self.__write_stanzas(stanza_items, leading_text)
+
+            self.stanzas.move(stanza_id, new_position)
+            self.leading_text = leading_text
+
+    def get_stanza(self, position):
+        """
+        Returns the ID and stanza at the given (zero-based) position.
+        Raises IndexError if there is no such stanza.
+        """
+        with self.lock:
+            return self.stanzas.get_id(position), self.stanzas[position]
+
+    def get_stanza_by_id(self, stanza_id):
+        """
+        Returns the (zero-based) position and stanza with the given ID.
+        Raises KeyError if there is no such stanza.
+        """
+        with self.lock:
+            return self.stanzas.index(stanza_id), self.stanzas.get(stanza_id)
+
+    def get_stanza_id(self, position):
+        """Returns the ID of the stanza at the given (zero-based) position"""
+        return self.stanzas.get_id(position)
+
+    def get_stanza_position(self, stanza_id):
+        """
+        Returns the (zero-based) position of the stanza with the given ID,
+        or None if there is no such stanza
+        """
+        with self.lock:
+            if stanza_id not in self.stanzas:
+                return None
+            return self.stanzas.index(stanza_id)
+
+    def list_stanzas(self):
+        """
+        Returns (zero-based position, ID, stanza) tuples for all stanzas,
+        taken from a single consistent view of the stanza list
+        """
+        with self.lock:
+            return [(i, stanza_id, stanza) for i, (stanza_id, stanza)
+                    in enumerate(self.stanzas.items())]
+
+    def get_manifest(self):
+        """
+        Returns the digest of the stanza list and the hash of each stanza,
+        in order, for comparing this server's stanzas with another's
+        """
+        with self.lock:
+            hashes = [stanza.get_hash() for stanza in self.stanzas]
+        return {"digest": StanzaUtil.get_digest(hashes), "hashes": hashes}
+
+    def get_delta(self, manifest):
+        """
+        Returns the changes needed to make the stanzas of the server that
+        produced the given manifest match this server's stanzas. Only
+        stanzas the other server does not have are included in full.
+        """
+        # Take the hashes and the stanzas from the same view of the list
+        with self.lock:
+            own_manifest = self.get_manifest()
+            stanzas = list(self.stanzas)
+        delta = {
+            "base": manifest["digest"],
+            "digest": own_manifest["digest"]
+        }
+        if delta["base"] == delta["digest"]:
+            return delta
+        known = set(manifest["hashes"])
+        delta["hashes"] = own_manifest["hashes"]
+        delta["stanzas"] = {
+            stanza.get_hash():
+                stanza.text or StanzaUtil.print_stanzas([stanza])
+            for stanza in stanzas if stanza.get_hash() not in known
+        }
+        return delta
+
+    def apply_delta(self, delta):
+        """
+        Apply a delta from get_delta() to the stanzas, then write
+        databases.conf once. Stanzas that are kept retain their IDs.
+        Returns False if the stanzas were already up to date.
+        Raises ValueError if the delta does not apply to these stanzas.
+        """
+        if delta["base"] != delta["digest"] and \
+                StanzaUtil.get_digest(delta["hashes"]) != delta["digest"]:
+            raise ValueError("Delta hashes do not match its digest")
+        with self.lock:
+            current = self.get_manifest()["digest"]
+            if current != delta["base"]:
+                raise ValueError(
+                    "Delta was computed for a different set of stanzas")
+            if delta["base"] == delta["digest"]:
+                return False
+
+            known = {}
+            for stanza in self.stanzas:
+                known[stanza.get_hash()] = stanza
+            for stanza_hash, stanza_text in delta["stanzas"].items():
+                parsed_stanzas = StanzaUtil.parse_stanza_file(stanza_text)[0]
+                if len(parsed_stanzas) != 1 or \
+                        parsed_stanzas[0].get_hash() != stanza_hash:
+                    raise ValueError(
+                        f"Stanza text does not match hash {stanza_hash}")
+                known[stanza_hash] = parsed_stanzas[0]
+
+            new_stanzas = []
+            for stanza_hash in delta["hashes"]:
+                if stanza_hash not in known:
+                    raise ValueError(f"Missing stanza for hash {stanza_hash}")
+                new_stanzas.append(known[stanza_hash])
+            ids = self.__assign_ids(new_stanzas, self.stanzas.items())
+
+            stanzas = StanzaList(new_stanzas, ids)
+            leading_text = {stanza_id: self.leading_text[stanza_id]
+                            for stanza_id in stanzas.nodes
+                            if stanza_id in self.leading_text}
+            self.__write_stanzas(stanzas.items(), leading_text)
+            groups = self.__index_groups(stanzas)
+            self.stanzas = stanzas
+            self.groups = groups
+            self.leading_text = leading_text
+        return True
+
+    def get_stanza_usage(self, log_paths, processes=None):
+        """
+        Count the hits and last-seen time of each stanza in the given
+        EZproxy access logs. Positions in the report are zero-based.
+        """
+        stanzas = self.list_stanzas()
+        report = analyze_logs(
+            log_paths, [stanza for _, _, stanza in stanzas], processes)
+        for stanza_usage, (_, stanza_id, _) in zip(report["stanzas"], stanzas):
+            stanza_usage["id"] = stanza_id
+        return report
+
+    def analyze_stanzas(self, start=0):
+        """
+        Report duplicate, shadowed, Domain-covered and incomplete stanzas.
+        Positions in the report are numbered from start.
+        """
+        with self.lock:
+            return StanzaUtil.analyze_stanzas(self.stanzas, start)
+
+    def get_groups(self):
+        """Returns the names of all groups with at least one stanza"""
+        with self.lock:
+            return list(self.groups.keys())
+
+    def get_group_sizes(self):
+        """Returns the number of stanzas in each group, by group name"""
+        with self.lock:
+            return OrderedDict((group, len(stanza_ids))
+                               for group, stanza_ids in self.groups.items())
+
+    def get_group_positions(self, group):
+        """Returns the (zero-based) positions of the stanzas in a group"""
+        with self.lock:
+            return sorted(self.stanzas.index(stanza_id)
+                          for stanza_id in self.groups.get(group, ()))
+
+    def get_group_stanzas(self, group):
+        """
+        Returns (zero-based position, ID, stanza) tuples for a group, taken
+        from a single consistent view of the stanza list
+        """
+        with self.lock:
+            return sorted(
+                (self.stanzas.index(stanza_id), stanza_id,
+                 self.stanzas.get(stanza_id))
+                for stanza_id in self.groups.get(group, ())
+            )
+
+    @SEARCH_SECONDS.time()
+    def search_proxy(self, url=None, name=None, group=None):
         """
-        Search proxy instance for existing stanza with origin URL
+        Search proxy instance for existing stanza with origin URL,
+        optionally limited to the stanzas of a single group
         """
         url_matches = set()
         name_matches = set()
         try:
-            for i in range(len(self.get_stanzas())):
-                stanza = self.get_stanzas()[i]
+            if group is None:
+                candidates = [(i, stanza) for i, _, stanza
+                              in self.list_stanzas()]
+            else:
+                candidates = [(i, stanza) for i, _, stanza
+                              in self.get_group_stanzas(group)]
+            for i, stanza in candidates:
                 if url:
                     for origin in stanza.get_origins():
                         if StanzaUtil.match_origin_url(url, origin):
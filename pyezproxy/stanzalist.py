@@ -0,0 +1,220 @@
+"""Module for an ordered list of stanzas addressable by stable ID"""
+import uuid
+import random
+
+
+class StanzaList:
+    """
+    Sequence of stanzas where each stanza has an ID that does not change
+    when stanzas are inserted, removed or reordered.
+    Stanzas are kept in an implicit treap: a randomly balanced binary tree
+    ordered by position, where each node knows the size of its subtree and
+    its parent. Looking up, inserting, removing or moving a stanza by
+    position or by ID takes O(log n) expected time.
+    """
+
+    def __init__(self, stanzas=(), ids=None):
+        self.root = None
+        self.nodes = {}
+        self.insert_all(0, stanzas, ids)
+
+    def __len__(self):
+        return _size(self.root)
+
+    def __iter__(self):
+        for node in self.__iter_nodes():
+            yield node.stanza
+
+    def __contains__(self, stanza_id):
+        return stanza_id in self.nodes
+
+    def __getitem__(self, position):
+        return self.__node_at(position).stanza
+
+    def __setitem__(self, position, stanza):
+        self.__node_at(position).stanza = stanza
+
+    def items(self):
+        """Yields (ID, stanza) pairs in order"""
+        for node in self.__iter_nodes():
+            yield node.id, node.stanza
+
+    def get(self, stanza_id, default=None):
+        """Returns the stanza with the given ID"""
+        node = self.nodes.get(stanza_id)
+        return default if node is None else node.stanza
+
+    def get_id(self, position):
+        """Returns the ID of the stanza at the given position"""
+        return self.__node_at(position).id
+
+    def index(self, stanza_id):
+        """Returns the position of the stanza with the given ID"""
+        node = self.nodes[stanza_id]
+        position = _size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                position += _size(node.parent.left) + 1
+            node = node.parent
+        return position
+
+    def append(self, stanza, stanza_id=None):
+        """Add a stanza to the end, returning its ID"""
+        return self.insert(len(self), stanza, stanza_id)
+
+    def insert(self, position, stanza, stanza_id=None):
+        """Insert a stanza before the given position, returning its ID"""
+        return self.insert_all(position, [stanza], [stanza_id])[0]
+
+    def insert_all(self, position, stanzas, ids=None):
+        """
+        Insert stanzas in order before the given position, returning their
+        IDs. IDs that are not given are generated.
+        """
+        stanzas = list(stanzas)
+        if ids is None:
+            ids = [None] * len(stanzas)
+        new_ids = []
+        seen = set()
+        for stanza_id in ids:
+            if stanza_id is None:
+                stanza_id = uuid.uuid4().hex
+            elif stanza_id in self.nodes or stanza_id in seen:
+                raise ValueError(f"Duplicate stanza ID {stanza_id}")
+            new_ids.append(stanza_id)
+            seen.add(stanza_id)
+        middle = None
+        for stanza, stanza_id in zip(stanzas, new_ids):
+            node = _Node(stanza_id, stanza)
+            self.nodes[stanza_id] = node
+            middle = _merge(middle, node)
+        self.__insert_tree(self.__clamp(position), middle)
+        return new_ids
+
+    def pop(self, position=-1):
+        """Remove and return the stanza at the given position"""
+        node = self.__node_at(position)
+        self.__remove_node(node)
+        del self.nodes[node.id]
+        return node.stanza
+
+    def remove(self, stanza_id):
+        """Remove and return the stanza with the given ID"""
+        return self.pop(self.index(stanza_id))
+
+    def move(self, stanza_id, position):
+        """
+        Move the stanza with the given ID so that it ends up at the given
+        position, as a pop followed by an insert would
+        """
+        node = self.nodes[stanza_id]
+        self.__remove_node(node)
+        node.left = node.right = node.parent = None
+        node.size = 1
+        self.__insert_tree(self.__clamp(position), node)
+
+    def __insert_tree(self, position, tree):
+        left, right = _split(self.root, position)
+        self.root = _merge(_merge(left, tree), right)
+        if self.root is not None:
+            self.root.parent = None
+
+    def __remove_node(self, node):
+        position = self.index(node.id)
+        left, rest = _split(self.root, position)
+        _, right = _split(rest, 1)
+        self.root = _merge(left, right)
+        if self.root is not None:
+            self.root.parent = None
+
+    def __clamp(self, position):
+        # Same position handling as list.insert()
+        length = len(self)
+        if position < 0:
+            position = max(length + position, 0)
+        return min(position, length)
+
+    def __node_at(self, position):
+        length = len(self)
+        if position < 0:
+            position += length
+        if not 0 <= position < length:
+            raise IndexError("stanza index out of range")
+        node = self.root
+        while True:
+            left_size = _size(node.left)
+            if position < left_size:
+                node = node.left
+            elif position == left_size:
+                return node
+            else:
+                position -= left_size + 1
+                node = node.right
+
+    def __iter_nodes(self):
+        return _iter_tree(self.root)
+
+
+class _Node:
+    __slots__ = ("id", "stanza", "priority", "left", "right", "parent",
+                 "size")
+
+    def __init__(self, stanza_id, stanza):
+        self.id = stanza_id
+        self.stanza = stanza
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.parent = None
+        self.size = 1
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _update(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+    if node.left is not None:
+        node.left.parent = node
+    if node.right is not None:
+        node.right.parent = node
+
+
+def _split(node, count):
+    """Split a tree into its first count nodes and the rest"""
+    if node is None:
+        return None, None
+    if count <= _size(node.left):
+        left, node.left = _split(node.left, count)
+        _update(node)
+        return left, node
+    node.right, right = _split(node.right, count - _size(node.left) - 1)
+    _update(node)
+    return node, right
+
+
+def _merge(left, right):
+    """Join two trees, with every node of left before every node of right"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _iter_tree(node):
+    stack = []
+    while stack or node is not None:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node
+        node = node.right
@@ -1,5 +1,6 @@
 """This is a utility module for working with EZproxy stanzas"""
 
+import hashlib
 from os import path
 from urllib.parse import urlparse
 from collections import OrderedDict
@@ -13,6 +14,9 @@ class Stanza:
         self.group = stanza_array["config"].get("Group", "Default")
         self.directives = None
         self.__set_directives(stanza_array["config"])
+        # Text of the stanza as found in databases.conf, if it was read there
+        self.text = None
+        self.__hash = None
 
     def __set_directives(self, stanza_config):
         # Remove group key if already set
@@ -47,6 +51,23 @@ class Stanza:
         """Returns group if specified in stanza directives"""
         return self.group
 
+    def get_hash(self):
+        """
+        Returns a SHA-256 hex digest of this stanza's group and directives,
+        so equal stanzas on different servers hash equally regardless of
+        how they are formatted in databases.conf
+        """
+        if self.__hash is None:
+            lines = ["Group " + self.group]
+            for key, value in self.get_directives().items():
+                key = StanzaUtil.shortcuts.get(key.upper(), key)
+                values = value if isinstance(value, list) else [value]
+                for directive_value in values:
+                    lines.append(key + " " + directive_value)
+            self.__hash = hashlib.sha256(
+                b"\x00" + "\n".join(lines).encode("utf-8")).hexdigest()
+        return self.__hash
+
     def __sort_directives(self, key_tuple):
         # group goes first, then title, then everything else
         sorted_keys = {
@@ -65,6 +86,10 @@ class StanzaUtil:
         "D": "Domain",
         "DJ": "DomainJavascript"
     }
+    default_ports = {
+        "http": 80,
+        "https": 443
+    }
 
     def parse_stanzas(stanza_text):
         """Function to parse database stanza files"""
@@ -73,6 +98,44 @@ class StanzaUtil:
             stanza_array.append(StanzaUtil.parse_stanza(stanza_text))
         return stanza_array
 
+    def parse_stanza_file(stanzas_text):
+        """
+        Function to parse a database stanza file, keeping the text around
+        the stanzas so the file can be written back unchanged. Returns the
+        stanzas, the text before each stanza since the previous one, and
+        the text after the last stanza. Each stanza's text is set to its
+        block in the file, from the START line to the END line.
+        """
+        stanza_array = []
+        leading_texts = []
+        between = []
+        block = None
+        for line in stanzas_text.splitlines(True):
+            if not line.strip():
+                (between if block is None else block).append(line)
+            elif "START" in line:
+                # An unterminated block is kept as text around the stanzas
+                if block is not None:
+                    between.extend(block)
+                block = [line]
+            elif "END" in line and block is not None:
+                block.append(line)
+                stanza = StanzaUtil.parse_stanza("\n".join(
+                    block_line.strip() for block_line in block[1:-1]
+                    if block_line.strip()))
+                stanza.text = "".join(block)
+                stanza_array.append(stanza)
+                leading_texts.append("".join(between))
+                between = []
+                block = None
+            elif block is not None:
+                block.append(line)
+            else:
+                between.append(line)
+        if block is not None:
+            between.extend(block)
+        return stanza_array, leading_texts, "".join(between)
+
     def __extract_stanzas(stanzas_text):
         start = "START"
         end = "END"
@@ -121,7 +184,8 @@ class StanzaUtil:
     def print_stanzas(stanzas):
         lines = []
         for stanza in stanzas:
-            lines.append("#### " + stanza.name + " START ####")
+            name = stanza.name or "Untitled"
+            lines.append("#### " + name + " START ####")
             lines.append("Group " + stanza.group)
             directives = stanza.get_directives()
             for directive in directives:
@@ -130,10 +194,171 @@ class StanzaUtil:
                         lines.append(directive + " " + value)
                 else:
                     lines.append(directive + " " + directives[directive])
-            lines.append("#### " + stanza.name + " END   ####")
+            lines.append("#### " + name + " END   ####")
             lines.append("")  # Append blank line between stanzas.
         return "\n".join(lines)
 
+    def get_missing_directives(stanza):
+        """Returns which of the required Title and URL directives are missing"""
+        directives = set(
+            StanzaUtil.shortcuts.get(key.upper(), key)
+            for key in stanza.get_directives()
+        )
+        # Stanzas that only include another file are complete as is
+        if "IncludeFile" in directives:
+            return []
+        return [key for key in ("Title", "URL") if key not in directives]
+
+    def get_domains(stanza):
+        """
+        Returns the domains of a stanza's Domain and DomainJavascript
+        directives, in lowercase and without a leading dot
+        """
+        domains = []
+        directives = stanza.get_directives()
+        for key in directives:
+            if StanzaUtil.shortcuts.get(key.upper(), key) in \
+                    ("Domain", "DomainJavascript"):
+                values = directives[key]
+                if isinstance(values, str):
+                    values = [values]
+                domains.extend(
+                    value.strip().lower().lstrip(".") for value in values)
+        return domains
+
+    def analyze_stanzas(stanzas, start=0):
+        """
+        Reports conflicts between stanzas in a single indexed pass:
+        origins claimed by more than one stanza, stanzas whose origins are
+        all claimed by earlier stanzas, hosts covered by another stanza's
+        Domain directives, and stanzas without a Title or URL.
+        Positions are numbered from start.
+        """
+        # (hostname, port) -> scheme -> positions claiming that origin.
+        # Origins without a scheme are stored under "" and match any scheme.
+        # The port is None if it is the default port for the scheme.
+        owners = OrderedDict()
+        domains = {}
+        stanza_origins = []
+        incomplete = []
+        for position, stanza in enumerate(stanzas, start):
+            missing = StanzaUtil.get_missing_directives(stanza)
+            if missing:
+                incomplete.append({
+                    "position": position,
+                    "name": stanza.name,
+                    "missing": missing
+                })
+
+            origins = []
+            for origin in sorted(stanza.get_origins()):
+                parsed = urlparse(origin)
+                if not parsed.hostname:
+                    continue
+                port = parsed.port
+                if port == StanzaUtil.default_ports.get(parsed.scheme):
+                    port = None
+                key = (parsed.hostname, port)
+                claims = owners.setdefault(key, OrderedDict())
+                positions = claims.setdefault(parsed.scheme, [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+                origins.append((key, parsed.scheme))
+            stanza_origins.append((position, stanza, origins))
+
+            for domain in StanzaUtil.get_domains(stanza):
+                positions = domains.setdefault(domain, [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+
+        duplicates = []
+        for (hostname, port), claims in owners.items():
+            netloc = hostname + (":" + str(port) if port else "")
+            schemeless = claims.get("", [])
+            for scheme, positions in claims.items():
+                if scheme:
+                    claimants = sorted(set(positions) | set(schemeless))
+                elif len(claims) == 1:
+                    claimants = positions
+                else:
+                    # Reported together with the schemes it also matches
+                    continue
+                if len(claimants) > 1:
+                    duplicates.append({
+                        "origin": (scheme + ":" if scheme else "") +
+                        "//" + netloc,
+                        "positions": claimants
+                    })
+
+        shadowed = []
+        covered = []
+        for position, stanza, origins in stanza_origins:
+            shadowed_by = set()
+            for key, scheme in origins:
+                claims = owners[key]
+                schemeless = claims.get("", [position])[0]
+                if scheme:
+                    firsts = [min(claims[scheme][0], schemeless)]
+                elif schemeless < position:
+                    firsts = [schemeless]
+                else:
+                    # Without a scheme, the origin matches both http and
+                    # https, so it is only shadowed if both are claimed
+                    firsts = [claims.get(other, [position])[0]
+                              for other in ("http", "https")]
+                if max(firsts) >= position:
+                    shadowed_by = None
+                    break
+                shadowed_by.update(firsts)
+            if origins and shadowed_by:
+                shadowed.append({
+                    "position": position,
+                    "name": stanza.name,
+                    "shadowed_by": sorted(shadowed_by)
+                })
+
+            hostnames = OrderedDict((key[0], None) for key, _ in origins)
+            for hostname in hostnames:
+                labels = hostname.split(".")
+                for i in range(len(labels)):
+                    domain = ".".join(labels[i:])
+                    covered_by = [other for other in domains.get(domain, [])
+                                  if other != position]
+                    if covered_by:
+                        covered.append({
+                            "position": position,
+                            "name": stanza.name,
+                            "host": hostname,
+                            "domain": domain,
+                            "covered_by": covered_by
+                        })
+
+        return OrderedDict([
+            ("duplicate_origins", duplicates),
+            ("shadowed_stanzas", shadowed),
+            ("covered_hosts", covered),
+            ("incomplete_stanzas", incomplete)
+        ])
+
+    def get_digest(hashes):
+        """
+        Returns the Merkle root of an ordered list of stanza hashes. The
+        digest changes if any stanza changes or if stanzas are reordered.
+        """
+        level = [bytes.fromhex(stanza_hash) for stanza_hash in hashes]
+        if not level:
+            return hashlib.sha256(b"").hexdigest()
+        while len(level) > 1:
+            next_level = []
+            for i in range(0, len(level) - 1, 2):
+                next_level.append(hashlib.sha256(
+                    b"\x01" + level[i] + level[i + 1]).digest())
+            # An unpaired last node is carried up unchanged
+            if len(level) % 2:
+                next_level.append(level[-1])
+            level = next_level
+        return level[0].hex()
+
     def translate_url_origin(url):
         """Returns the origin URL of a given URL"""
         if "//" not in url:
@@ -1,5 +1,8 @@
 """Module for test cases"""
 
+import os
+import time
+import tempfile
 import unittest
 from unittest import mock
 from textwrap import dedent
@@ -7,6 +10,11 @@ from collections import OrderedDict
 from pyezproxy import stanzas
 from pyezproxy.stanzas import Stanza, StanzaUtil
 from pyezproxy.server import EzproxyServer
+from pyezproxy.metrics import HTTP_REQUESTS, MetricsRegistry
+from pyezproxy.options import ServerOptions
+from pyezproxy.stanzalist import StanzaList
+from pyezproxy.logs import OriginIndex, analyze_logs
+from pyezproxy.api import api
 
 
 class StanzaUtilTestCase(unittest.TestCase):
@@ -109,6 +117,89 @@ class StanzaUtilTestCase(unittest.TestCase):
         for shortcut in StanzaUtil.shortcuts.values():
             self.assertTrue(shortcut in stanza.get_directives())
 
+    def test_analyze_stanzas(self):
+        """Test for StanzaUtil.analyze_stanzas()"""
+        text = self.test_text + """
+        #### IPA Source Copy START ####
+        Title IPA Source Copy
+        URL https://www.ipasource.com/catalog
+        #### IPA Source Copy END ####
+
+        #### Mango Help START ####
+        Title Mango Help
+        URL http://help.mangolanguages.com
+        Host //www.ipasource.com
+        #### Mango Help END ####
+
+        #### Untitled START ####
+        Host http://example.com
+        #### Untitled END ####
+        """
+        report = StanzaUtil.analyze_stanzas(
+            StanzaUtil.parse_stanzas(dedent(text)))
+        self.assertEqual(report["duplicate_origins"], [{
+            "origin": "https://www.ipasource.com",
+            "positions": [1, 3, 4]
+        }])
+        self.assertEqual(report["shadowed_stanzas"], [{
+            "position": 3,
+            "name": "IPA Source Copy",
+            "shadowed_by": [1]
+        }])
+        self.assertEqual(report["covered_hosts"], [{
+            "position": 4,
+            "name": "Mango Help",
+            "host": "help.mangolanguages.com",
+            "domain": "mangolanguages.com",
+            "covered_by": [2]
+        }])
+        self.assertEqual(report["incomplete_stanzas"], [{
+            "position": 5,
+            "name": None,
+            "missing": ["Title", "URL"]
+        }])
+
+    def test_analyze_origin_variants(self):
+        """Test for StanzaUtil.analyze_stanzas() with ports and schemes"""
+        stanzas = StanzaUtil.parse_stanzas(dedent("""\
+            #### A START ####
+            URL https://example.com
+            #### A END ####
+            #### B START ####
+            URL https://example.com:443
+            #### B END ####
+            #### C START ####
+            Host //example.com
+            #### C END ####
+            #### D START ####
+            URL http://example.com:80
+            #### D END ####
+            #### E START ####
+            Host //example.com
+            #### E END ####
+            #### F START ####
+            URL http://www.jstor.org
+            #### F END ####
+            #### G START ####
+            URL https://www.jstor.org
+            #### G END ####
+            #### H START ####
+            Host www.jstor.org
+            #### H END ####
+            """))
+        report = StanzaUtil.analyze_stanzas(stanzas)
+        self.assertEqual(report["duplicate_origins"], [
+            {"origin": "https://example.com", "positions": [0, 1, 2, 4]},
+            {"origin": "http://example.com", "positions": [2, 3, 4]},
+            {"origin": "http://www.jstor.org", "positions": [5, 7]},
+            {"origin": "https://www.jstor.org", "positions": [6, 7]}
+        ])
+        self.assertEqual(
+            [(stanza["position"], stanza["shadowed_by"])
+             for stanza in report["shadowed_stanzas"]],
+            [(1, [0]), (3, [2]), (4, [2]), (7, [5, 6])]
+        )
+
     def test_translate(self):
         """Simple test for HTTP URL"""
         self.assertEqual(
@@ -207,6 +298,57 @@ class StanzaTestCase(unittest.TestCase):
         )
 
 
+class StanzaListTestCase(unittest.TestCase):
+    """Test cases for StanzaList class"""
+
+    def setUp(self):
+        self.stanza_list = StanzaList(["a", "b", "c", "d"])
+        self.ids = [self.stanza_list.get_id(i) for i in range(4)]
+
+    def assert_order(self, expected):
+        self.assertEqual(list(self.stanza_list), expected)
+        self.assertEqual(len(self.stanza_list), len(expected))
+        for i in range(len(expected)):
+            self.assertEqual(self.stanza_list[i], expected[i])
+            self.assertEqual(
+                self.stanza_list.index(self.stanza_list.get_id(i)), i)
+
+    def test_move(self):
+        self.stanza_list.move(self.ids[0], 2)
+        self.assert_order(["b", "c", "a", "d"])
+        self.assertEqual(self.stanza_list.index(self.ids[0]), 2)
+        self.stanza_list.move(self.ids[3], 0)
+        self.assert_order(["d", "b", "c", "a"])
+        self.assertEqual(self.stanza_list.get(self.ids[3]), "d")
+
+    def test_insert_and_pop(self):
+        new_ids = self.stanza_list.insert_all(1, ["x", "y"])
+        self.assert_order(["a", "x", "y", "b", "c", "d"])
+        self.assertEqual(self.stanza_list.index(new_ids[1]), 2)
+        self.assertEqual(self.stanza_list.pop(0), "a")
+        self.assertEqual(self.stanza_list.remove(self.ids[2]), "c")
+        self.assert_order(["x", "y", "b", "d"])
+        self.assertNotIn(self.ids[0], self.stanza_list)
+        self.assertEqual(self.stanza_list.index(self.ids[3]), 3)
+
+    def test_list_semantics(self):
+        reference = ["a", "b", "c", "d"]
+        for position, value in [(-1, "e"), (10, "f"), (-10, "g")]:
+            self.stanza_list.insert(position, value)
+            reference.insert(position, value)
+        self.assert_order(reference)
+        self.assertEqual(self.stanza_list[-1], reference[-1])
+        self.stanza_list[2] = "h"
+        reference[2] = "h"
+        self.assert_order(reference)
+        with self.assertRaises(IndexError):
+            self.stanza_list[len(reference)]
+
+    def test_duplicate_ids(self):
+        with self.assertRaises(ValueError):
+            self.stanza_list.insert(0, "x", self.ids[0])
+
+
 class EZProxyServerTestCase(unittest.TestCase):
     """Test cases for EzproxyServer class"""
 
@@ -415,6 +557,874 @@ class EZProxyServerTestCase(unittest.TestCase):
                 {(2, "Mango for Libraries - Chicago")}
             )
 
+    @mock.patch(
+        'pyezproxy.server.EzproxyServer._EzproxyServer__set_server_options')
+    def test_group_index(self, *args):
+        """Test for EzproxyServer group index"""
+        # Edits are written to databases.conf, so use a real config directory
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        os.mkdir(temp_dir.name + "/config")
+        grouped_text = dedent("""\
+            #### Sage Knowledge START ####
+            Group Main
+            Title Sage Knowledge
+            URL http://knowledge.sagepub.com
+            #### Sage Knowledge END ####
+
+            #### IPA Source START ####
+            Title IPA Source
+            URL https://www.ipasource.com
+            #### IPA Source END ####
+
+            #### JSTOR START ####
+            Group Main
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+            """)
+        with open(temp_dir.name + "/config/databases.conf", "w") \
+                as stanza_file:
+            stanza_file.write(grouped_text)
+        server = EzproxyServer("example.com", temp_dir.name)
+        self.assertEqual(server.get_groups(), ["Main", "Default"])
+        self.assertEqual(server.get_group_positions("Main"), [0, 2])
+        self.assertEqual(server.get_group_positions("Missing"), [])
+        self.assertEqual(
+            server.search_proxy("https://www.jstor.org", group="Main"),
+            {(2, "JSTOR")}
+        )
+        self.assertIsNone(
+            server.search_proxy("https://www.jstor.org", group="Default"))
+
+        server.move_stanza(2, 0)
+        self.assertEqual(server.get_group_positions("Main"), [0, 1])
+        server.add_stanza(StanzaUtil.parse_stanza(
+            "Group Main\nTitle Example\nURL http://example.com"))
+        self.assertEqual(server.get_group_positions("Main"), [0, 1, 3])
+        with open(temp_dir.name + "/config/databases.conf") as stanza_file:
+            self.assertEqual(
+                [stanza.name
+                 for stanza in StanzaUtil.parse_stanzas(stanza_file.read())],
+                ["JSTOR", "Sage Knowledge", "IPA Source", "Example"]
+            )
+
+        # Stanzas can be edited by ID without first looking up the position
+        stanza_id = server.get_stanza_id(3)
+        server.move_stanza_by_id(stanza_id, 0)
+        server.replace_stanza_by_id(stanza_id, StanzaUtil.parse_stanza(
+            "Title Example\nURL http://example.com"))
+        self.assertEqual(server.get_stanza_by_id(stanza_id)[0], 0)
+        self.assertEqual(server.get_group_sizes(),
+                         {"Main": 2, "Default": 2})
+        with self.assertRaises(KeyError):
+            server.move_stanza_by_id("missing", 0)
+
+
+class ConfigDirTestCase(unittest.TestCase):
+    """Base for test cases using configuration files in a temp directory"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.base_dir = self.temp_dir.name
+        os.mkdir(self.base_dir + "/config")
+        self.write_file("databases.conf", dedent("""\
+            #### IPA Source START ####
+            Title IPA Source
+            URL https://www.ipasource.com
+            #### IPA Source END ####
+            """))
+        self.write_file("server.conf", "Name ezproxy.example.com\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_file(self, name, text):
+        with open(self.base_dir + "/config/" + name, "w") as config_file:
+            config_file.write(text)
+
+    def read_file(self, name):
+        with open(self.base_dir + "/config/" + name, "r") as config_file:
+            return config_file.read()
+
+
+class ConfigWatcherTestCase(ConfigDirTestCase):
+    """Test cases for reloading configuration files on change"""
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    @mock.patch("pyezproxy.watcher.inotify_simple", None)
+    def test_reload_on_change(self):
+        server = EzproxyServer("example.com", self.base_dir)
+        server.watch(debounce=0.05, poll_interval=0.02)
+        try:
+            self.write_file("databases.conf", dedent("""\
+                #### JSTOR START ####
+                Group Main
+                Title JSTOR
+                URL https://www.jstor.org
+                #### JSTOR END ####
+                """))
+            self.write_file("server.conf", "Name other.example.com\n")
+            self.assertTrue(self.wait_for(
+                lambda: server.stanzas[0].name == "JSTOR"))
+            self.assertEqual(server.get_groups(), ["Main"])
+            self.assertTrue(self.wait_for(
+                lambda: server.options.get("Name") == "other.example.com"))
+        finally:
+            server.stop_watching()
+
+    @mock.patch("pyezproxy.watcher.inotify_simple", None)
+    def test_skip_reload_after_own_write(self):
+        server = EzproxyServer("example.com", self.base_dir)
+        with mock.patch.object(server, "reload_stanzas") as reload_stanzas:
+            server.watch(debounce=0.05, poll_interval=0.02)
+            try:
+                server.add_stanza(StanzaUtil.parse_stanza(
+                    "Title JSTOR\nURL https://www.jstor.org"))
+                self.write_file("server.conf", "Name other.example.com\n")
+                self.assertTrue(self.wait_for(
+                    lambda: server.options.get("Name") ==
+                    "other.example.com"))
+            finally:
+                server.stop_watching()
+        reload_stanzas.assert_not_called()
+
+    @mock.patch("pyezproxy.watcher.inotify_simple", None)
+    def test_reload_changes_before_watching(self):
+        server = EzproxyServer("example.com", self.base_dir)
+        self.write_file("databases.conf", dedent("""\
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+            """))
+        server.watch(debounce=0.05, poll_interval=0.02)
+        try:
+            self.assertTrue(self.wait_for(
+                lambda: server.stanzas[0].name == "JSTOR"))
+            server.add_stanza(StanzaUtil.parse_stanza(
+                "Title Example\nURL http://example.com"))
+        finally:
+            server.stop_watching()
+        self.assertEqual(len(server.stanzas), 2)
+
+    def test_refuse_write_over_changes(self):
+        server = EzproxyServer("example.com", self.base_dir)
+        changed_text = dedent("""\
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+            """)
+        self.write_file("databases.conf", changed_text)
+        with self.assertRaises(RuntimeError):
+            server.replace_stanza(0, StanzaUtil.parse_stanza(
+                "Title Example\nURL http://example.com"))
+        with self.assertRaises(RuntimeError):
+            server.add_stanza(StanzaUtil.parse_stanza(
+                "Title Example\nURL http://example.com"))
+        self.assertEqual(len(server.stanzas), 1)
+        self.assertEqual(self.read_file("databases.conf"), changed_text)
+
+        server.reload_stanzas()
+        server.add_stanza(StanzaUtil.parse_stanza(
+            "Title Example\nURL http://example.com"))
+        self.assertEqual(
+            [stanza.name for stanza in server.stanzas], ["JSTOR", "Example"])
+
+    @mock.patch("pyezproxy.watcher.inotify_simple", None)
+    def test_keep_state_on_failed_reload(self):
+        server = EzproxyServer("example.com", self.base_dir)
+        os.remove(self.base_dir + "/config/databases.conf")
+        with self.assertRaises(OSError):
+            server.reload_stanzas()
+        self.assertEqual(server.stanzas[0].name, "IPA Source")
+
+    def test_reload_keeps_ids(self):
+        server = EzproxyServer("example.com", self.base_dir)
+        stanza_id = server.get_stanza_id(0)
+        self.write_file("databases.conf", dedent("""\
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+
+            #### IPA Source START ####
+            Title IPA Source
+            URL https://www.ipasource.com/new
+            #### IPA Source END ####
+            """))
+        server.reload_stanzas()
+        self.assertEqual(server.get_stanza_position(stanza_id), 1)
+        self.assertNotEqual(server.get_stanza_id(0), stanza_id)
+
+
+    def test_ids_survive_restart(self):
+        self.write_file("databases.conf", dedent("""\
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org/stable
+            #### JSTOR END ####
+            """))
+        server = EzproxyServer("example.com", self.base_dir)
+        ids = [server.get_stanza_id(0), server.get_stanza_id(1)]
+        self.assertNotEqual(ids[0], ids[1])
+        new_id = server.add_stanza(StanzaUtil.parse_stanza(
+            "Title Example\nURL http://example.com"))
+        restarted = EzproxyServer("example.com", self.base_dir)
+        self.assertEqual([stanza_id for _, stanza_id, _
+                          in restarted.list_stanzas()], ids + [new_id])
+
+        # Swapping stanzas with the same name by hand swaps their positions,
+        # not their IDs
+        self.write_file("databases.conf", dedent("""\
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org/stable
+            #### JSTOR END ####
+
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+            """))
+        server.reload_stanzas()
+        self.assertEqual(server.get_stanza_position(ids[0]), 1)
+        self.assertEqual(server.get_stanza_position(ids[1]), 0)
+
+
+class StanzaImportTestCase(ConfigDirTestCase):
+    """Test cases for importing several stanzas at once"""
+
+    def setUp(self):
+        super().setUp()
+        self.server = EzproxyServer("example.com", self.base_dir)
+        self.import_text = dedent("""\
+            #### JSTOR START ####
+            Group Main
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+
+            #### Sage Knowledge START ####
+            Title Sage Knowledge
+            URL http://knowledge.sagepub.com
+            #### Sage Knowledge END ####
+            """)
+
+    def test_import_stanzas(self):
+        inserted = self.server.import_stanzas(self.import_text, 0)
+        self.assertEqual(inserted, [(0, self.server.get_stanza_id(0)),
+                                    (1, self.server.get_stanza_id(1))])
+        self.assertEqual(
+            [stanza.name for stanza in self.server.stanzas],
+            ["JSTOR", "Sage Knowledge", "IPA Source"]
+        )
+        self.assertEqual(self.server.get_group_positions("Default"), [1, 2])
+        self.assertEqual(
+            self.read_file("databases.conf"),
+            self.import_text + "\n" +
+            dedent("""\
+                #### IPA Source START ####
+                Title IPA Source
+                URL https://www.ipasource.com
+                #### IPA Source END ####
+                """)
+        )
+
+    def test_import_keeps_file_text(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               "databases.conf")) as stanza_file:
+            original_text = stanza_file.read()
+        self.write_file("databases.conf", original_text)
+        server = EzproxyServer("example.com", self.base_dir)
+        server.import_stanzas(self.import_text, 1)
+        new_text = self.read_file("databases.conf")
+        # Everything before IPA Source is kept, with the new stanzas spliced
+        # in just above its START line
+        ipa_start = original_text.index("#### IPA Source START")
+        self.assertTrue(new_text.startswith(original_text[:ipa_start]))
+        self.assertTrue(new_text.endswith(original_text[ipa_start:]))
+        self.assertIn("#### JSTOR START", new_text[ipa_start:])
+        self.assertEqual(
+            [stanza.name for stanza in StanzaUtil.parse_stanzas(new_text)],
+            ["Sage Knowledge", "JSTOR", "Sage Knowledge", "IPA Source",
+             "Mango for Libraries - Chicago"]
+        )
+
+    def test_move_keeps_file_header(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               "databases.conf")) as stanza_file:
+            original_text = stanza_file.read()
+        self.write_file("databases.conf", original_text)
+        server = EzproxyServer("example.com", self.base_dir)
+        server.move_stanza(0, 2)
+        new_text = self.read_file("databases.conf")
+        sage_start = original_text.index("#### Sage Knowledge START")
+        self.assertTrue(new_text.startswith(original_text[:sage_start]))
+        self.assertEqual(new_text.count("EBOOK TYPE RESOURCES"), 1)
+        self.assertIn("#### Mango for Libraries END ####\n\n"
+                      "#### Sage Knowledge START", new_text)
+        self.assertEqual(
+            [stanza.name for stanza in StanzaUtil.parse_stanzas(new_text)],
+            ["IPA Source", "Mango for Libraries - Chicago", "Sage Knowledge"]
+        )
+
+        # Moving it back restores the file
+        server.move_stanza(2, 0)
+        self.assertEqual(
+            [stanza.name for stanza in StanzaUtil.parse_stanzas(
+                self.read_file("databases.conf"))],
+            ["Sage Knowledge", "IPA Source", "Mango for Libraries - Chicago"]
+        )
+        self.assertTrue(self.read_file("databases.conf").startswith(
+            original_text[:sage_start]))
+
+    def test_move_separates_comments(self):
+        self.write_file("databases.conf", dedent("""\
+            #### IPA Source START ####
+            Title IPA Source
+            URL https://www.ipasource.com
+            #### IPA Source END ####
+            # Journals
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+            """))
+        server = EzproxyServer("example.com", self.base_dir)
+        server.move_stanza(1, 0)
+        self.assertEqual(self.read_file("databases.conf"), dedent("""\
+            # Journals
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+
+            #### IPA Source START ####
+            Title IPA Source
+            URL https://www.ipasource.com
+            #### IPA Source END ####
+            """))
+        server.move_stanza(0, 1)
+        self.assertIn("#### IPA Source END ####\n\n# Journals\n",
+                      self.read_file("databases.conf"))
+
+    @mock.patch("os.replace", side_effect=OSError("disk full"))
+    def test_import_failed_write(self, *args):
+        self.write_file("databases.conf", dedent("""\
+            #### Untitled START ####
+            Host http://example.com
+            #### Untitled END ####
+            """))
+        server = EzproxyServer("example.com", self.base_dir)
+        with self.assertRaises(OSError):
+            server.import_stanzas(self.import_text)
+        self.assertEqual(len(server.stanzas), 1)
+        self.assertEqual(server.get_groups(), ["Default"])
+        self.assertEqual(os.listdir(self.base_dir + "/config"),
+                         ["databases.conf", "server.conf"])
+
+    def test_import_invalid_stanzas(self):
+        invalid_text = self.import_text + dedent("""\
+            #### Untitled START ####
+            URL http://example.com
+            #### Untitled END ####
+            """)
+        original_text = self.read_file("databases.conf")
+        with self.assertRaises(ValueError):
+            self.server.import_stanzas(invalid_text)
+        with self.assertRaises(ValueError):
+            self.server.import_stanzas(self.import_text, 5)
+        self.assertEqual(len(self.server.stanzas), 1)
+        self.assertEqual(self.read_file("databases.conf"), original_text)
+
+
+class StanzaSyncTestCase(ConfigDirTestCase):
+    """Test cases for syncing stanzas between servers"""
+
+    def setUp(self):
+        super().setUp()
+        self.source = EzproxyServer("example.com", self.base_dir)
+        self.source.import_stanzas(dedent("""\
+            #### JSTOR START ####
+            Group Main
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+
+            #### Mango for Libraries START ####
+            Title Mango for Libraries - Chicago
+            URL https://connect.mangolanguages.com/mbicl/start
+            DJ mangolanguages.com
+            #### Mango for Libraries END ####
+            """))
+        self.target_dir = tempfile.TemporaryDirectory()
+        os.mkdir(self.target_dir.name + "/config")
+        for name in ("databases.conf", "server.conf"):
+            with open(self.target_dir.name + "/config/" + name, "w") \
+                    as config_file:
+                config_file.write(self.read_file(name))
+        self.target = EzproxyServer("example.org", self.target_dir.name)
+
+    def tearDown(self):
+        self.target_dir.cleanup()
+        super().tearDown()
+
+    def test_digest(self):
+        manifest = self.source.get_manifest()
+        self.assertEqual(manifest, self.target.get_manifest())
+        self.assertEqual(
+            manifest["hashes"],
+            [stanza.get_hash() for stanza in self.source.stanzas]
+        )
+        self.source.move_stanza(0, 2)
+        self.assertNotEqual(
+            self.source.get_manifest()["digest"], manifest["digest"])
+
+    def test_sync_unchanged(self):
+        delta = self.source.get_delta(self.target.get_manifest())
+        self.assertEqual(delta["base"], delta["digest"])
+        self.assertNotIn("stanzas", delta)
+        self.assertFalse(self.target.apply_delta(delta))
+
+    def test_sync_untitled_stanza(self):
+        self.source.import_stanzas(dedent("""\
+            #### Example START ####
+            Title Example
+            URL http://example.com
+            #### Example END ####
+            """))
+        self.source.replace_stanza(3, StanzaUtil.parse_stanza(
+            "Host http://example.com"))
+        manifest = self.source.get_manifest()
+        self.assertEqual(len(manifest["hashes"]), 4)
+
+        delta = self.source.get_delta(self.target.get_manifest())
+        self.assertTrue(self.target.apply_delta(delta))
+        self.assertEqual(self.target.get_manifest(), manifest)
+        self.assertIsNone(self.target.stanzas[3].name)
+
+    def test_sync_changes(self):
+        kept_id = self.target.get_stanza_id(0)
+        self.source.replace_stanza(1, StanzaUtil.parse_stanza(
+            "Group Main\nTitle JSTOR\nURL https://www.jstor.org/stable"))
+        self.source.move_stanza(2, 0)
+        delta = self.source.get_delta(self.target.get_manifest())
+        self.assertEqual(len(delta["stanzas"]), 1)
+
+        self.assertTrue(self.target.apply_delta(delta))
+        self.assertEqual(
+            self.target.get_manifest(), self.source.get_manifest())
+        self.assertEqual(self.target.get_stanza_position(kept_id), 1)
+        self.assertEqual(self.target.get_group_positions("Main"), [2])
+        with open(self.target_dir.name + "/config/databases.conf") \
+                as config_file:
+            target_text = config_file.read()
+        # Stanzas are written as they were found, not reformatted
+        self.assertIn("DJ mangolanguages.com\n", target_text)
+        self.assertEqual(
+            [stanza.get_hash()
+             for stanza in StanzaUtil.parse_stanzas(target_text)],
+            self.source.get_manifest()["hashes"]
+        )
+
+        # A delta only applies to the stanzas it was computed against
+        with self.assertRaises(ValueError):
+            self.target.apply_delta(delta)
+
+
+class ApiTestCase(ConfigDirTestCase):
+    """Test cases for the HTTP API"""
+
+    def setUp(self):
+        super().setUp()
+        self.server = EzproxyServer("example.com", self.base_dir)
+        self.server.import_stanzas(dedent("""\
+            #### JSTOR START ####
+            Group Main
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+
+            #### Sage Knowledge START ####
+            Title Sage Knowledge
+            URL http://knowledge.sagepub.com
+            #### Sage Knowledge END ####
+            """))
+        patcher = mock.patch.object(api, "server", self.server)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = api.app.test_client()
+
+    def test_stanza_by_id(self):
+        stanza_id = self.server.get_stanza_id(2)
+        response = self.client.get("/stanzas/id/" + stanza_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["position"], 3)
+
+        response = self.client.patch("/stanzas/id/" + stanza_id,
+                                     json={"position": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.get_stanza_position(stanza_id), 0)
+        response = self.client.put("/stanzas/id/" + stanza_id, json={
+            "text": "Title Sage\nURL http://knowledge.sagepub.com"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.stanzas[0].name, "Sage")
+
+    def test_stanza_not_found(self):
+        self.assertEqual(
+            self.client.get("/stanzas/id/missing").status_code, 404)
+        self.assertEqual(self.client.put("/stanzas/id/missing", json={
+            "text": "Title Example\nURL http://example.com"
+        }).status_code, 404)
+        self.assertEqual(self.client.patch(
+            "/stanzas/id/missing", json={"position": 1}).status_code, 404)
+        self.assertEqual(self.client.get("/stanzas/0").status_code, 404)
+        self.assertEqual(self.client.put("/stanzas/9", json={
+            "text": "Title Example\nURL http://example.com"
+        }).status_code, 404)
+        self.assertEqual(self.client.patch(
+            "/stanzas/9", json={"position": 1}).status_code, 404)
+
+    def test_invalid_positions(self):
+        stanza_id = self.server.get_stanza_id(0)
+        for position in ("2", True, None, 0, 4):
+            self.assertEqual(self.client.patch(
+                "/stanzas/id/" + stanza_id, json={"position": position}
+            ).status_code, 400)
+            self.assertEqual(self.client.patch(
+                "/stanzas/1", json={"position": position}
+            ).status_code, 400)
+            self.assertEqual(self.client.post("/stanzas/bulk", json={
+                "text": "Title Example\nURL http://example.com",
+                "position": position
+            }).status_code, 400)
+        self.assertEqual(self.server.get_stanza_position(stanza_id), 0)
+        self.assertEqual(len(self.server.stanzas), 3)
+
+    def test_bulk_import(self):
+        response = self.client.post("/stanzas/bulk", json={
+            "text": dedent("""\
+                #### Example START ####
+                Title Example
+                URL http://example.com
+                #### Example END ####
+                """),
+            "position": 1
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()["positions"], [1])
+        self.assertEqual(response.get_json()["ids"],
+                         [self.server.get_stanza_id(0)])
+        self.assertEqual(self.client.post("/stanzas/bulk", json={
+            "text": "#### Example START ####\nTitle Example\n"
+                    "#### Example END ####\n"
+        }).status_code, 400)
+
+    def test_changed_on_disk(self):
+        self.write_file("databases.conf", self.read_file("databases.conf") +
+                        "# Edited by hand\n")
+        stanza_id = self.server.get_stanza_id(0)
+        text = "Title Example\nURL http://example.com"
+        self.assertEqual(self.client.post(
+            "/stanzas", json={"text": text}).status_code, 409)
+        self.assertEqual(self.client.put(
+            "/stanzas/1", json={"text": text}).status_code, 409)
+        self.assertEqual(self.client.patch(
+            "/stanzas/id/" + stanza_id, json={"position": 2}).status_code,
+            409)
+        self.assertEqual(self.client.post("/stanzas/bulk", json={
+            "text": "#### Example START ####\n" + text +
+                    "\n#### Example END ####\n"
+        }).status_code, 409)
+        self.assertEqual(len(self.server.stanzas), 3)
+
+    def test_groups(self):
+        self.assertEqual(self.client.get("/groups").get_json(), [
+            {"name": "Default", "count": 2},
+            {"name": "Main", "count": 1}
+        ])
+        self.assertEqual(
+            self.client.get("/groups/Missing/stanzas").status_code, 404)
+
+    def test_options(self):
+        self.assertEqual(self.client.get("/options/Name").get_json()[
+            "values"], ["ezproxy.example.com"])
+        self.assertEqual(
+            self.client.get("/options/Missing").status_code, 404)
+
+    def test_analysis(self):
+        self.assertEqual(self.client.get("/analysis").status_code, 200)
+        self.server.add_stanza(StanzaUtil.parse_stanza(
+            "Title JSTOR Copy\nURL https://www.jstor.org"))
+        response = self.client.get("/analysis")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()["shadowed_stanzas"][0][
+            "position"], 4)
+
+    def test_sync(self):
+        manifest = self.client.get("/sync").get_json()
+        self.assertEqual(manifest, self.server.get_manifest())
+        self.assertEqual(
+            self.client.post("/sync/delta", json={}).status_code, 400)
+        delta = self.client.post("/sync/delta", json=manifest).get_json()
+        self.assertEqual(delta["base"], delta["digest"])
+        self.assertEqual(
+            self.client.post("/sync/apply", json=delta).status_code, 200)
+        # A delta computed against other stanzas does not apply here
+        delta = self.client.post("/sync/delta", json={
+            "digest": "0" * 64, "hashes": []}).get_json()
+        self.assertEqual(
+            self.client.post("/sync/apply", json=delta).status_code, 409)
+
+    def test_metrics(self):
+        self.client.get("/groups")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('pyezproxy_http_requests_total{method="GET",'
+                      'route="/groups",status="200"}',
+                      response.get_data(as_text=True))
+
+
+    def test_metrics_count_failures(self):
+        key = ("GET", "/groups", "500")
+        failures = HTTP_REQUESTS.values.get(key, 0)
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        with mock.patch.object(self.server, "get_group_sizes",
+                               side_effect=KeyError("group")), \
+                mock.patch.dict(api.app.config, {
+                    "PROFILE_SAMPLE_RATE": 1.0,
+                    "PROFILE_DIR": profile_dir.name}):
+            self.assertEqual(self.client.get("/groups").status_code, 500)
+            self.assertEqual(HTTP_REQUESTS.values.get(key), failures + 1)
+            # after_request handlers are skipped for exceptions that are
+            # propagated, but the request is still counted
+            with mock.patch.dict(api.app.config,
+                                 {"PROPAGATE_EXCEPTIONS": True}):
+                with self.assertRaises(KeyError):
+                    self.client.get("/groups")
+        self.assertEqual(HTTP_REQUESTS.values.get(key), failures + 2)
+        self.assertEqual(len(os.listdir(profile_dir.name)), 2)
+
+
+class LogAnalyzerTestCase(unittest.TestCase):
+    """Test cases for mapping access log entries to stanzas"""
+
+    def setUp(self):
+        self.stanzas = StanzaUtil.parse_stanzas(dedent("""\
+            #### JSTOR START ####
+            Title JSTOR
+            URL https://www.jstor.org
+            #### JSTOR END ####
+
+            #### Mango for Libraries START ####
+            Title Mango for Libraries - Chicago
+            URL https://connect.mangolanguages.com/mbicl/start
+            HJ http://libraries.mangolanguages.com/mbicl/start
+            #### Mango for Libraries END ####
+
+            #### IPA Source START ####
+            Title IPA Source
+            URL https://www.ipasource.com
+            #### IPA Source END ####
+            """))
+        log_lines = [
+            '10.0.0.1 - user1 [01/Mar/2018:10:00:00 -0600] '
+            '"GET https://www.jstor.org:443/stable/123 HTTP/1.1" 200 512',
+            '10.0.0.2 - user2 [01/Mar/2018:09:00:00 -0600] '
+            '"GET http://libraries.mangolanguages.com:80/a HTTP/1.1" 200 1',
+            '10.0.0.1 - user1 [02/Mar/2018:08:30:00 -0600] '
+            '"GET /login?url=https://www.jstor.org/action HTTP/1.1" 302 0',
+            '10.0.0.3 - - [02/Mar/2018:09:00:00 -0600] '
+            '"GET http://www.example.com:80/ HTTP/1.1" 200 10',
+            'not a log line',
+        ]
+        self.log_file = tempfile.NamedTemporaryFile(
+            "w", suffix=".log", delete=False)
+        with self.log_file:
+            self.log_file.write("\n".join(log_lines * 50) + "\n")
+
+    def tearDown(self):
+        os.remove(self.log_file.name)
+
+    def check_report(self, report):
+        self.assertEqual(
+            [(usage["name"], usage["hits"], usage["last_seen"])
+             for usage in report["stanzas"]],
+            [
+                ("JSTOR", 100, "2018-03-02T08:30:00-06:00"),
+                ("Mango for Libraries - Chicago", 50,
+                 "2018-03-01T09:00:00-06:00"),
+                ("IPA Source", 0, None)
+            ]
+        )
+        self.assertEqual(report["unmatched"], 50)
+
+    def test_analyze_logs(self):
+        self.check_report(analyze_logs(
+            [self.log_file.name], self.stanzas, chunk_size=1000))
+
+    def test_analyze_logs_in_processes(self):
+        self.check_report(analyze_logs(
+            [self.log_file.name], self.stanzas, processes=2,
+            chunk_size=1000))
+
+    def test_resolve_domains(self):
+        index = OriginIndex(StanzaUtil.parse_stanzas(dedent("""\
+            #### IPA Source START ####
+            Title IPA Source
+            URL https://www.ipasource.com
+            #### IPA Source END ####
+
+            #### Mango for Libraries START ####
+            Title Mango for Libraries - Chicago
+            URL https://connect.mangolanguages.com/mbicl/start
+            DJ .MangoLanguages.com
+            #### Mango for Libraries END ####
+
+            #### Mango Help START ####
+            Title Mango Help
+            URL http://help.mangolanguages.com
+            D ipasource.com
+            #### Mango Help END ####
+            """)))
+        self.assertEqual(index.resolve("https://www.ipasource.com/a"), 0)
+        self.assertEqual(index.resolve("http://cdn.ipasource.com:8080/"), 2)
+        self.assertEqual(index.resolve("http://mangolanguages.com/"), 1)
+        # The earlier Domain wins over a later stanza for the exact host
+        self.assertEqual(index.resolve("http://help.mangolanguages.com/"), 1)
+        self.assertIsNone(index.resolve("https://notmangolanguages.com/"))
+
+
+class ServerOptionsTestCase(unittest.TestCase):
+    """Test cases for ServerOptions class"""
+
+    def setUp(self):
+        self.options_text = dedent("""\
+            ## Host configuration
+            Name chilib-test.moody.edu
+            Interface 172.26.200.26
+            loginPort 80
+            Interface 172.26.200.27
+            ProxyByHostname
+
+            LoginCookieName EZProxyCHI
+            """)
+        self.options = ServerOptions(self.options_text)
+
+    def test_get(self):
+        self.assertEqual(self.options.get("name"), "chilib-test.moody.edu")
+        self.assertEqual(self.options.get("LOGINPORT"), "80")
+        self.assertEqual(self.options.get("ProxyByHostname"), "")
+        self.assertIsNone(self.options.get("Missing"))
+        self.assertNotIn("Missing", self.options)
+
+    def test_get_all(self):
+        self.assertEqual(
+            self.options.get_all("interface"),
+            ["172.26.200.26", "172.26.200.27"]
+        )
+        self.assertEqual(self.options.get_lines("Interface"), [3, 5])
+
+    def test_to_dict(self):
+        self.assertEqual(
+            list(self.options.to_dict().items())[:3],
+            [
+                ("Name", ["chilib-test.moody.edu"]),
+                ("Interface", ["172.26.200.26", "172.26.200.27"]),
+                ("LoginPort", ["80"])
+            ]
+        )
+
+    def test_round_trip(self):
+        self.assertEqual(self.options.get_text(), self.options_text)
+
+    def test_edit(self):
+        self.options.set("LoginPort", "8080")
+        self.options.add("Interface", "172.26.200.28")
+        self.options.add("MaxSessions", "500")
+        self.assertEqual(self.options.get_all("Interface")[-1],
+                         "172.26.200.28")
+        self.assertEqual(self.options.get_lines("LoginCookieName"), [9])
+        self.assertEqual(
+            self.options.get_text(),
+            dedent("""\
+                ## Host configuration
+                Name chilib-test.moody.edu
+                Interface 172.26.200.26
+                LoginPort 8080
+                Interface 172.26.200.27
+                Interface 172.26.200.28
+                ProxyByHostname
+
+                LoginCookieName EZProxyCHI
+                MaxSessions 500
+                """)
+        )
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Test cases for metrics module"""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_render_counter(self):
+        counter = self.registry.counter(
+            "test_total", "Test counter.", ["result"])
+        counter.inc(result="ok")
+        counter.inc(2, result="ok")
+        self.assertEqual(
+            self.registry.render(),
+            dedent("""\
+                # HELP test_total Test counter.
+                # TYPE test_total counter
+                test_total{result="ok"} 3.0
+                """)
+        )
+
+    def test_render_histogram(self):
+        histogram = self.registry.histogram(
+            "test_seconds", "Test histogram.", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        rendered = self.registry.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0', rendered)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', rendered)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', rendered)
+        self.assertIn("test_seconds_sum 5.55", rendered)
+        self.assertIn("test_seconds_count 3.0", rendered)
+
+    def test_timer_decorator(self):
+        histogram = self.registry.histogram("test_seconds", "Test.")
+
+        @histogram.time()
+        def timed_function():
+            return "result"
+
+        self.assertEqual(timed_function(), "result")
+        self.assertIn("test_seconds_count 1.0", self.registry.render())
+
+    def test_missing_labels(self):
+        counter = self.registry.counter("test_total", "Test.", ["result"])
+        with self.assertRaises(ValueError):
+            counter.inc()
+
 
 if __name__ == '__main__':
     unittest.main()
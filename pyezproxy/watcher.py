@@ -0,0 +1,138 @@
+"""Module for watching EZproxy configuration files for changes"""
+import os
+import time
+import logging
+import threading
+
+try:
+    import inotify_simple
+except ImportError:  # pragma: no cover - depends on the platform
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_signature(path):
+    """
+    Returns the inode, size and modification time of a file, which change
+    whenever it is written or replaced, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    Background thread that calls a reload function when a watched file
+    changes. Changes are detected with inotify when inotify_simple is
+    installed, falling back to polling file modification times. Bursts of
+    changes to a file are debounced into a single reload, and files that
+    are unchanged since they were last loaded or recorded are not reloaded.
+    """
+
+    def __init__(self, callbacks, debounce=1.0, poll_interval=2.0,
+                 signatures=None):
+        super().__init__(name="pyezproxy-config-watcher", daemon=True)
+        # Map of absolute file path to the function reloading it
+        self.callbacks = {
+            os.path.abspath(path): callback
+            for path, callback in callbacks.items()
+        }
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.pending = {}
+        # Signatures of the files as last loaded, and as last polled. The
+        # caller can give the signatures of the files as it loaded them, so
+        # changes made before watching started are reloaded too.
+        self.signatures = {
+            path: get_signature(path) for path in self.callbacks
+        }
+        for path, signature in (signatures or {}).items():
+            self.signatures[os.path.abspath(path)] = signature
+        self.polled = dict(self.signatures)
+        self.inotify = None
+        self.watches = {}
+
+    def stop(self):
+        """Stop watching and wait for the thread to finish"""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def record(self, path):
+        """
+        Note that a file was just written by this process, so the change
+        does not trigger a reload
+        """
+        path = os.path.abspath(path)
+        signature = get_signature(path)
+        self.polled[path] = signature
+        self.signatures[path] = signature
+
+    def run(self):
+        if inotify_simple is not None:
+            self.__start_inotify()
+        for path in self.callbacks:
+            if get_signature(path) != self.signatures.get(path):
+                self.pending[path] = time.monotonic()
+        try:
+            while not self.stopped.is_set():
+                if self.inotify is not None:
+                    changed = self.__read_inotify()
+                else:
+                    self.stopped.wait(self.poll_interval)
+                    changed = self.__poll()
+                now = time.monotonic()
+                for path in changed:
+                    self.pending[path] = now
+                for path, changed_at in list(self.pending.items()):
+                    if now - changed_at >= self.debounce:
+                        del self.pending[path]
+                        self.__reload(path)
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+    def __start_inotify(self):
+        # Watch the parent directories, since editors often replace a file
+        # by renaming a new one over it rather than writing it in place.
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        self.inotify = inotify_simple.INotify()
+        for directory in {os.path.dirname(path) for path in self.callbacks}:
+            self.watches[self.inotify.add_watch(directory, mask)] = directory
+
+    def __read_inotify(self):
+        # Wake up at least once per debounce period to flush pending reloads
+        timeout = self.debounce if self.pending else self.poll_interval
+        changed = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            path = os.path.join(self.watches[event.wd], event.name)
+            if path in self.callbacks:
+                changed.add(path)
+        return changed
+
+    def __poll(self):
+        changed = set()
+        for path in self.callbacks:
+            signature = get_signature(path)
+            if signature != self.polled.get(path):
+                self.polled[path] = signature
+                changed.add(path)
+        return changed
+
+    def __reload(self, path):
+        signature = get_signature(path)
+        if signature == self.signatures.get(path):
+            return
+        self.signatures[path] = signature
+        try:
+            self.callbacks[path]()
+        except Exception:
+            # Keep the previously loaded configuration if the new one is
+            # unreadable, and keep watching for the next change.
+            logger.exception("Failed to reload %s", path)
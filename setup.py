@@ -12,4 +12,7 @@ setup(name='pyezproxy',
         'requests',
         'beautifulsoup4'
       ],
+      extras_require={
+        'inotify': ['inotify_simple']
+      },
       zip_safe=False)